@@ -1,6 +1,8 @@
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, LabeledPrice
+from telebot.apihelper import ApiTelegramException
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
 import sqlite3
 import logging
@@ -10,6 +12,22 @@ import schedule
 import time
 import csv
 import io
+import os
+import gzip
+import json
+import hashlib
+import queue
+import html
+import heapq
+import bisect
+import functools
+import itertools
+import random
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
 # 🔧 Настройка логирования
 logging.basicConfig(
@@ -31,249 +49,1596 @@ PAYMENT_TOKEN = ''
 # 📢 ID канала, на который нужно подписаться
 CHANNEL_ID = '@your_channel_username'
 
+# ⚡ Параметры параллельного мониторинга
+MONITORING_WORKERS = 16  # сколько пользователей обрабатывается одновременно
+MONITORING_FETCH_WORKERS = 32  # общий пул для загрузки товаров по акциям
+MARKETPLACE_CONCURRENCY = {
+    'ozon': 8,  # максимум одновременных запросов к API Ozon
+    'wb': 8,  # максимум одновременных запросов к API Wildberries
+}
+OZON_PAGE_SIZE = 100  # товаров на страницу при загрузке акции Ozon
+WB_PAGE_SIZE = 1000  # товаров на страницу при загрузке акции Wildberries
+
+# 📈 Адаптивная частота опроса пользователей
+POLL_TICK = 30  # сек между проверками, кому из пользователей пора в мониторинг
+POLL_MIN_INTERVAL = 120  # сек, самый частый опрос
+POLL_DEFAULT_INTERVAL = 600  # сек, интервал для нового пользователя
+POLL_MAX_INTERVAL = 3600  # сек, самый редкий опрос
+POLL_BACKOFF_FACTOR = 1.5  # во сколько раз растёт интервал после цикла без изменений
+POLL_BOUNDARY_WINDOW = 1800  # сек вокруг начала/окончания акции, когда опрос идёт с минимальным интервалом
+
+# 🌐 Параметры HTTP-клиента для API маркетплейсов
+HTTP_CONNECT_TIMEOUT = 5  # сек
+HTTP_READ_TIMEOUT = 30  # сек
+HTTP_POOL_SIZE = 16  # соединений на один хост
+HTTP_MAX_RETRIES = 3  # повторы только для идемпотентных запросов на чтение
+HTTP_RETRY_BACKOFF = 0.5  # базовая задержка между повторами, сек
+HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# 🚦 Лимиты запросов на один API-ключ: хост -> {путь: (запросов в секунду, всплеск)}, '' — для остальных путей
+MARKETPLACE_RATE_LIMITS = {
+    'api-seller.ozon.ru': {
+        '': (10, 10),
+        '/v1/actions/products/deactivate': (2, 2),
+    },
+    'suppliers-api.wildberries.ru': {
+        '': (5, 5),
+        '/api/v1/calendar/prices': (1, 2),
+    },
+}
+MARKETPLACE_HOSTS = {
+    'api-seller.ozon.ru': 'ozon',
+    'suppliers-api.wildberries.ru': 'wb',
+}
+CIRCUIT_FAILURE_THRESHOLD = 5  # подряд неудачных запросов, после которых маркетплейс считается недоступным
+CIRCUIT_RESET_TIMEOUT = 30  # сек до пробного запроса к недоступному маркетплейсу
+
+# 📨 Лимиты отправки сообщений в Telegram
+TELEGRAM_SEND_WORKERS = 4
+TELEGRAM_GLOBAL_RATE = 25  # сообщений в секунду на весь бот
+TELEGRAM_PER_CHAT_RATE = 1  # сообщений в секунду в один чат
+TELEGRAM_PER_CHAT_BURST = 3
+TELEGRAM_MAX_RETRIES = 3  # повторы после ответа 429
+TELEGRAM_MAX_TRACKED_CHATS = 10000
+PRIORITY_INTERACTIVE = 0  # ответы на действия пользователя
+PRIORITY_BULK = 10  # уведомления мониторинга
+
+# 🗄️ Параметры базы данных
+DB_PATH = 'marketplace_bot.db'
+DB_BUSY_TIMEOUT = 30  # сек ожидания блокировки
+DB_WRITE_BATCH_SIZE = 200  # максимум операций записи в одной групповой транзакции
+USER_CACHE_TTL = 60  # сек жизни закэшированной строки пользователя
+USER_CACHE_SIZE = 10000  # максимум пользователей в кэше
+IGNORED_CACHE_PRODUCTS = 1000000  # максимум товаров-исключений всех пользователей в памяти
+ANALYTICS_WINDOW_DAYS = 30  # дней в аналитике пользователя
+PRODUCT_STATS_WINDOW_DAYS = 90  # дней в подробной статистике товара
+
+# 🧹 Хранение журналов и обслуживание базы
+LOG_RETENTION_DAYS = 180  # записи ozon_actions/wb_actions старше этого срока уходят в архив
+PENDING_RETENTION_DAYS = 30  # через сколько дней удаляются выполненные и dead задачи автоотмены
+ARCHIVE_DIR = 'archive'  # архивы журналов: <таблица>_<ГГГГ-ММ>.csv.gz
+MAINTENANCE_TIME = '03:30'  # ежедневный запуск обслуживания
+MAINTENANCE_BATCH_SIZE = 5000  # строк за одну транзакцию удаления
+MAINTENANCE_VACUUM_PAGES = 2000  # страниц за один шаг incremental_vacuum
+
+# ⏳ Настройки очереди отложенных действий
+PENDING_ACTION_DELAY = 3600  # сек до автоматической отмены акции
+PENDING_LEASE_TIMEOUT = 300  # сек, после которых незавершённая задача снова становится доступной
+PENDING_MAX_ATTEMPTS = 5  # после стольких неудачных попыток задача уходит в dead
+PENDING_RETRY_BACKOFF = 60  # сек, база экспоненциальной задержки повтора
+PENDING_CLAIM_LIMIT = 5000  # максимум задач, забираемых за один проход
+
+# 📰 Параметры уведомлений мониторинга
+NOTIFICATION_MODE = 'digest'  # 'digest' — одна сводка на акцию, 'per_product' — сообщение на каждый товар
+DIGEST_PAGE_SIZE = 20  # товаров на странице сводки
+DIGEST_NAME_LENGTH = 80  # символов названия товара в строке сводки: 20 строк укладываются в лимит Telegram 4096
+DIGEST_TITLE_LENGTH = 100  # символов названия акции в заголовке сводки
+OZON_BULK_CHUNK_SIZE = 1000  # товаров в одном запросе на удаление из акции Ozon
+WB_BULK_CHUNK_SIZE = 1000  # товаров в одном запросе на возврат скидки Wildberries
+
+# 📊 Загрузка шаблона цен
+PRICE_TEMPLATE_CHUNK_SIZE = 5000  # строк в одной пачке записи во временную таблицу
+PRICE_TEMPLATE_MAX_ERRORS = 1000  # сколько ошибок с номерами строк хранить для отчёта
+PRICE_TEMPLATE_MARKETPLACES = ('wb', 'ozon')  # значения необязательной колонки marketplace, по умолчанию wb
+PRICE_FLOOR_CACHE_SIZE = 100  # пользователей, чьи пороги цен держатся в памяти
+
+# 💹 Симулятор прибыльности акций
+SIMULATION_TOP_SIZE = 10  # акций и самых убыточных товаров в отчёте
+SIMULATION_EXPORT_LIMIT = 100000  # строк в CSV-выгрузке, самые убыточные первыми
+
+# 🌍 Способ получения обновлений Telegram
+BOT_MODE = 'polling'  # 'polling' — long polling, 'webhook' — встроенный HTTP-сервер
+WEBHOOK_URL = ''  # публичный https-адрес, который Telegram будет вызывать, например https://example.com/telegram
+WEBHOOK_LISTEN = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/telegram'
+WEBHOOK_SECRET_TOKEN = ''  # проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = 8  # потоков обработки обновлений
+WEBHOOK_QUEUE_SIZE = 1000  # обновлений в очереди; при переполнении Telegram получает 503 и повторит позже
+WEBHOOK_MAX_BODY = 1024 * 1024  # байт
+
+# 📈 Метрики в формате Prometheus
+METRICS_LISTEN = '127.0.0.1'  # метрики доступны только локально
+METRICS_PORT = 9108  # 0 — не запускать HTTP-сервер метрик
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)  # сек
+
+# 📈 Метрики: счётчики и гистограммы задержек, отдаются в текстовом формате Prometheus
+class MetricsRegistry:
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters = {}  # (имя, метки) -> значение
+        self._histograms = {}  # (имя, метки) -> [количество по корзинам, сумма, количество]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        # Копия снимается под блокировкой, форматирование идёт без неё
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._histograms.items())
+        lines = []
+        previous = None
+        for (name, labels), value in counters:
+            if name != previous:
+                lines.append(f"# TYPE {name} counter")
+                previous = name
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (counts, total, count) in histograms:
+            if name != previous:
+                lines.append(f"# TYPE {name} histogram")
+                previous = name
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', str(bound))])} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+def instrumented(metric, **labels):
+    # <metric>_duration_seconds и <metric>_errors_total с меткой function — имя обёрнутой функции
+    # (для методов вместе с классом: UserCache.get)
+    def decorator(func):
+        function_labels = dict(labels, function=func.__qualname__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                metrics.inc(f"{metric}_errors_total", **function_labels)
+                raise
+            finally:
+                metrics.observe(f"{metric}_duration_seconds", time.perf_counter() - started, **function_labels)
+        return wrapper
+    return decorator
+
+def start_metrics_server(listen=METRICS_LISTEN, port=METRICS_PORT):
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(f"Metrics {self.address_string()}: {format % args}")
+
+    httpd = ThreadingHTTPServer((listen, port), MetricsRequestHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Metrics available at http://{httpd.server_address[0]}:{httpd.server_address[1]}/metrics")
+    return httpd
+
 # 🤖 Инициализация бота
-bot = telebot.TeleBot(BOT_TOKEN)
-
-# 🗄️ Инициализация базы данных
-conn = sqlite3.connect('marketplace_bot.db', check_same_thread=False)
-cursor = conn.cursor()
-
-# 📊 Создание таблиц в базе данных
-cursor.execute('''CREATE TABLE IF NOT EXISTS users
-                  (id INTEGER PRIMARY KEY, chat_id INTEGER UNIQUE, subscription_end DATE, balance REAL DEFAULT 0, 
-                   ozon_api_key TEXT, ozon_client_id TEXT, wb_api_key TEXT, subscription_type TEXT,
-                   auto_cancel_enabled INTEGER DEFAULT 0, monitoring_enabled INTEGER DEFAULT 1,
-                   ozon_action_id TEXT, wb_promotion_id TEXT)''')
-cursor.execute('''CREATE TABLE IF NOT EXISTS ignored_products
-                  (id INTEGER PRIMARY KEY, user_id INTEGER, marketplace TEXT, product_id TEXT)''')
-cursor.execute('''CREATE TABLE IF NOT EXISTS promo_codes
-                  (id INTEGER PRIMARY KEY, code TEXT UNIQUE, discount REAL, uses INTEGER DEFAULT 0)''')
-cursor.execute('''CREATE TABLE IF NOT EXISTS referrals
-                  (id INTEGER PRIMARY KEY, referrer_id INTEGER, referred_id INTEGER, date DATE)''')
-cursor.execute('''CREATE TABLE IF NOT EXISTS ozon_actions
-                  (id INTEGER PRIMARY KEY, user_id INTEGER, action_type TEXT, product_id TEXT, date DATETIME)''')
-cursor.execute('''CREATE TABLE IF NOT EXISTS wb_actions
-                  (id INTEGER PRIMARY KEY, user_id INTEGER, action_type TEXT, product_id TEXT, date DATETIME)''')
-cursor.execute('''CREATE TABLE IF NOT EXISTS pending_actions
-                  (id INTEGER PRIMARY KEY, user_id INTEGER, marketplace TEXT, product_id TEXT, action_type TEXT, 
-                   notification_time DATETIME)''')
-cursor.execute('''CREATE TABLE IF NOT EXISTS ozon_promotions
-                  (id INTEGER PRIMARY KEY, user_id INTEGER, action_id INTEGER, title TEXT, 
-                   action_type TEXT, date_start TEXT, date_end TEXT, is_participating INTEGER)''')
-cursor.execute('''CREATE TABLE IF NOT EXISTS wb_promotions
-                  (id INTEGER PRIMARY KEY, user_id INTEGER, promotion_id INTEGER, title TEXT, 
-                   date_start TEXT, date_end TEXT, is_participating INTEGER)''')
-cursor.execute('''CREATE TABLE IF NOT EXISTS wb_prices
-                  (id INTEGER PRIMARY KEY, user_id INTEGER, nmId TEXT, price REAL, discount REAL)''')
-conn.commit()
+# В режиме webhook обработчики выполняются в пуле обработки обновлений, а не во внутреннем пуле telebot
+bot = telebot.TeleBot(BOT_TOKEN, threaded=BOT_MODE != 'webhook')
+
+# 📨 Очередь исходящих сообщений Telegram
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now=None):
+        # Сколько секунд ждать до появления токена (0, если токен уже есть)
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self._refill(now)
+            return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._refill(now)
+            self.tokens -= 1
+
+    def try_acquire(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def block(self, seconds):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self, now):
+        with self._lock:
+            self._refill(now)
+            return now >= self.blocked_until and self.tokens >= self.capacity
+
+class OutboundJob:
+    def __init__(self, chat_id, priority, func, args, kwargs):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.attempts = 0
+        self.queued_at = time.monotonic()
+        self.future = Future()
+
+class OutboundMessageQueue:
+    def __init__(self, workers=TELEGRAM_SEND_WORKERS, global_rate=TELEGRAM_GLOBAL_RATE,
+                 per_chat_rate=TELEGRAM_PER_CHAT_RATE, per_chat_burst=TELEGRAM_PER_CHAT_BURST):
+        self.workers = workers
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._ready = []  # (priority, seq, job) — можно отправлять, как только есть токены
+        self._delayed = []  # (ready_at, seq, job) — чат исчерпал лимит или получил retry_after
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def _ensure_workers(self):
+        if not self._threads:
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"telegram-send-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= TELEGRAM_MAX_TRACKED_CHATS:
+                self._chats = {key: value for key, value in self._chats.items() if not value.is_idle(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        return bucket
+
+    def submit(self, chat_id, func, *args, priority=PRIORITY_BULK, **kwargs):
+        job = OutboundJob(chat_id, priority, func, args, kwargs)
+        with self._cond:
+            self._ensure_workers()
+            heapq.heappush(self._ready, (priority, next(self._seq), job))
+            self._cond.notify()
+        return job.future
+
+    def pending(self):
+        with self._cond:
+            return len(self._ready) + len(self._delayed)
+
+    def _retry_later(self, job, seconds):
+        with self._cond:
+            heapq.heappush(self._delayed, (time.monotonic() + seconds, next(self._seq), job))
+            self._cond.notify()
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, seq, job = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (job.priority, seq, job))
+
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                if self._ready:
+                    _, seq, job = self._ready[0]
+                    bucket = self._chat_bucket(job.chat_id, now)
+                    chat_delay = bucket.delay(now)
+                    if chat_delay > 0:
+                        # Не держим воркер на занятом чате, пропускаем вперед сообщения в другие чаты
+                        heapq.heappop(self._ready)
+                        heapq.heappush(self._delayed, (now + chat_delay, seq, job))
+                        continue
+                    global_delay = self._global.delay(now)
+                    if global_delay == 0:
+                        heapq.heappop(self._ready)
+                        self._global.consume(now)
+                        bucket.consume(now)
+                        return job
+                    timeout = global_delay if timeout is None else min(timeout, global_delay)
+                self._cond.wait(timeout)
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job.future.cancelled():
+                continue
+            method = job.func.__name__
+            started = time.monotonic()
+            metrics.observe('telegram_queue_wait_seconds', started - job.queued_at, method=method)
+            try:
+                result = job.func(*job.args, **job.kwargs)
+            except ApiTelegramException as e:
+                metrics.inc('telegram_api_errors_total', method=method, code=e.error_code)
+                if e.error_code == 429 and job.attempts < TELEGRAM_MAX_RETRIES:
+                    retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                    job.attempts += 1
+                    logger.warning(f"Telegram flood limit for chat {job.chat_id}, retrying in {retry_after}s")
+                    with self._cond:
+                        self._chat_bucket(job.chat_id, time.monotonic()).block(retry_after)
+                    self._retry_later(job, retry_after)
+                else:
+                    job.future.set_exception(e)
+            except Exception as e:
+                metrics.inc('telegram_api_errors_total', method=method, code='exception')
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            finally:
+                metrics.observe('telegram_api_duration_seconds', time.monotonic() - started, method=method)
+
+outbound_queue = OutboundMessageQueue()
+
+# Интерактивные ответы ставятся в очередь с высоким приоритетом и ждут отправки
+def send_message(chat_id, text, **kwargs):
+    return outbound_queue.submit(chat_id, bot.send_message, chat_id, text,
+                                 priority=PRIORITY_INTERACTIVE, **kwargs).result()
+
+def reply_to(message, text, **kwargs):
+    return outbound_queue.submit(message.chat.id, bot.reply_to, message, text,
+                                 priority=PRIORITY_INTERACTIVE, **kwargs).result()
+
+def edit_message_text(text, chat_id, message_id, **kwargs):
+    return outbound_queue.submit(chat_id, bot.edit_message_text, text, chat_id, message_id,
+                                 priority=PRIORITY_INTERACTIVE, **kwargs).result()
+
+def send_document(chat_id, document, **kwargs):
+    return outbound_queue.submit(chat_id, bot.send_document, chat_id, document,
+                                 priority=PRIORITY_INTERACTIVE, **kwargs).result()
+
+# Массовые уведомления мониторинга отправляются в фоне с низким приоритетом
+def notify(chat_id, text, **kwargs):
+    def log_failure(future):
+        if future.exception():
+            logger.error(f"Error sending notification to user {chat_id}: {future.exception()}")
+    future = outbound_queue.submit(chat_id, bot.send_message, chat_id, text, priority=PRIORITY_BULK, **kwargs)
+    future.add_done_callback(log_failure)
+    return future
+
+# 🗄️ Слой доступа к базе данных
+class Database:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = queue.Queue()
+        self._writer_conn = self._connect(check_same_thread=False)
+        # Действует только для новой базы; существующую переводит python main2.py --vacuum
+        self._writer_conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._writer_conn.execute("PRAGMA journal_mode = WAL")
+        self._writer_conn.execute("PRAGMA synchronous = NORMAL")
+        self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self, check_same_thread=True):
+        # isolation_level=None: транзакциями управляем сами
+        return sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, isolation_level=None,
+                               check_same_thread=check_same_thread)
+
+    def _reader(self):
+        # У каждого потока свое соединение для чтения, в WAL читатели не ждут писателя
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+            connection.execute("PRAGMA query_only = ON")
+        return connection
+
+    def fetchone(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return self._reader().execute(sql, params).fetchone()
+        finally:
+            metrics.observe('db_operation_duration_seconds', time.perf_counter() - started, operation='read')
+
+    def fetchall(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return self._reader().execute(sql, params).fetchall()
+        finally:
+            metrics.observe('db_operation_duration_seconds', time.perf_counter() - started, operation='read')
+
+    def transaction(self, func, wait=True):
+        # func(cursor) выполняется в потоке писателя внутри общей транзакции
+        if threading.current_thread() is self._writer:
+            return func(self._writer_conn.cursor())
+        future = Future()
+        self._writes.put((func, future))
+        if not wait:
+            return future
+        started = time.perf_counter()
+        try:
+            return future.result()
+        finally:
+            metrics.observe('db_operation_duration_seconds', time.perf_counter() - started, operation='write')
+
+    def execute(self, sql, params=(), wait=True):
+        return self.transaction(lambda cursor: cursor.execute(sql, params).rowcount, wait)
+
+    def executemany(self, sql, seq_of_params, wait=True):
+        seq_of_params = list(seq_of_params)
+        return self.transaction(lambda cursor: cursor.executemany(sql, seq_of_params).rowcount, wait)
+
+    def vacuum(self):
+        # VACUUM не выполняется внутри транзакции, поэтому идёт мимо потока писателя отдельным соединением
+        connection = self._connect()
+        try:
+            connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.execute("VACUUM")
+        finally:
+            connection.close()
+
+    def _writer_loop(self):
+        connection = self._writer_conn
+        while True:
+            # Групповой коммит: все накопившиеся записи фиксируются одной транзакцией
+            batch = [self._writes.get()]
+            while len(batch) < DB_WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+
+            results = []
+            try:
+                connection.execute("BEGIN IMMEDIATE")
+                for func, future in batch:
+                    # Ошибка одной операции откатывает только ее, а не весь пакет
+                    connection.execute("SAVEPOINT write_job")
+                    try:
+                        result = func(connection.cursor())
+                    except Exception as e:
+                        connection.execute("ROLLBACK TO write_job")
+                        connection.execute("RELEASE write_job")
+                        results.append((future, e, None))
+                    else:
+                        connection.execute("RELEASE write_job")
+                        results.append((future, None, result))
+                connection.execute("COMMIT")
+            except sqlite3.Error as e:
+                logger.error(f"Database error in writer: {e}")
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for future, error, result in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+db = Database(DB_PATH)
+
+# 📊 Миграции схемы базы данных
+# Каждая миграция применяется один раз, номер последней хранится в PRAGMA user_version
+# Цена товара в акции (у Ozon — цена акции, у Wildberries — цена со скидкой) минус порог из шаблона цен
+PROMO_MARGIN_SQL = """(
+    SELECT COALESCE(promo_snapshots.discount_price,
+                    promo_snapshots.price * (100 - promo_snapshots.discount) / 100.0)
+           - p.price * (100 - p.discount) / 100.0
+    FROM wb_prices p
+    WHERE p.user_id = promo_snapshots.user_id AND p.marketplace = promo_snapshots.marketplace
+      AND p.nmId = promo_snapshots.product_id
+)"""
+
+MIGRATIONS = [
+    (1, "initial schema", [
+        '''CREATE TABLE IF NOT EXISTS users
+           (id INTEGER PRIMARY KEY, chat_id INTEGER UNIQUE, subscription_end DATE, balance REAL DEFAULT 0, 
+            ozon_api_key TEXT, ozon_client_id TEXT, wb_api_key TEXT, subscription_type TEXT,
+            auto_cancel_enabled INTEGER DEFAULT 0, monitoring_enabled INTEGER DEFAULT 1,
+            ozon_action_id TEXT, wb_promotion_id TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS ignored_products
+           (id INTEGER PRIMARY KEY, user_id INTEGER, marketplace TEXT, product_id TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS promo_codes
+           (id INTEGER PRIMARY KEY, code TEXT UNIQUE, discount REAL, uses INTEGER DEFAULT 0)''',
+        '''CREATE TABLE IF NOT EXISTS referrals
+           (id INTEGER PRIMARY KEY, referrer_id INTEGER, referred_id INTEGER, date DATE)''',
+        '''CREATE TABLE IF NOT EXISTS ozon_actions
+           (id INTEGER PRIMARY KEY, user_id INTEGER, action_type TEXT, product_id TEXT, date DATETIME)''',
+        '''CREATE TABLE IF NOT EXISTS wb_actions
+           (id INTEGER PRIMARY KEY, user_id INTEGER, action_type TEXT, product_id TEXT, date DATETIME)''',
+        '''CREATE TABLE IF NOT EXISTS pending_actions
+           (id INTEGER PRIMARY KEY, user_id INTEGER, marketplace TEXT, product_id TEXT, action_type TEXT, 
+            notification_time DATETIME)''',
+        '''CREATE TABLE IF NOT EXISTS ozon_promotions
+           (id INTEGER PRIMARY KEY, user_id INTEGER, action_id INTEGER, title TEXT, 
+            action_type TEXT, date_start TEXT, date_end TEXT, is_participating INTEGER)''',
+        '''CREATE TABLE IF NOT EXISTS wb_promotions
+           (id INTEGER PRIMARY KEY, user_id INTEGER, promotion_id INTEGER, title TEXT, 
+            date_start TEXT, date_end TEXT, is_participating INTEGER)''',
+        '''CREATE TABLE IF NOT EXISTS wb_prices
+           (id INTEGER PRIMARY KEY, user_id INTEGER, nmId TEXT, price REAL, discount REAL)''',
+        '''CREATE TABLE IF NOT EXISTS promo_snapshots
+           (id INTEGER PRIMARY KEY, user_id INTEGER, marketplace TEXT, action_id TEXT, product_id TEXT,
+            name TEXT, price REAL, discount_price REAL, discount REAL, updated_at DATETIME,
+            UNIQUE (user_id, marketplace, action_id, product_id))''',
+    ]),
+    (2, "indexes and unique constraints for hot lookups", [
+        # Дубликаты, которые мешают уникальным индексам
+        """DELETE FROM ignored_products WHERE id NOT IN
+           (SELECT MIN(id) FROM ignored_products GROUP BY user_id, marketplace, product_id)""",
+        """DELETE FROM referrals WHERE id NOT IN (SELECT MIN(id) FROM referrals GROUP BY referred_id)""",
+        """DELETE FROM ozon_promotions WHERE id NOT IN (SELECT MAX(id) FROM ozon_promotions GROUP BY user_id, action_id)""",
+        """DELETE FROM wb_promotions WHERE id NOT IN (SELECT MAX(id) FROM wb_promotions GROUP BY user_id, promotion_id)""",
+        """DELETE FROM wb_prices WHERE id NOT IN (SELECT MAX(id) FROM wb_prices GROUP BY user_id, nmId)""",
+        "CREATE UNIQUE INDEX idx_ignored_products_user ON ignored_products (user_id, marketplace, product_id)",
+        "CREATE INDEX idx_pending_actions_due ON pending_actions (notification_time)",
+        "CREATE INDEX idx_ozon_actions_user_date ON ozon_actions (user_id, date)",
+        "CREATE INDEX idx_wb_actions_user_date ON wb_actions (user_id, date)",
+        "CREATE INDEX idx_referrals_referrer ON referrals (referrer_id)",
+        "CREATE UNIQUE INDEX idx_referrals_referred ON referrals (referred_id)",
+        "CREATE UNIQUE INDEX idx_ozon_promotions_user ON ozon_promotions (user_id, action_id)",
+        "CREATE UNIQUE INDEX idx_wb_promotions_user ON wb_promotions (user_id, promotion_id)",
+        "CREATE UNIQUE INDEX idx_wb_prices_user ON wb_prices (user_id, nmId)",
+        "CREATE INDEX idx_users_monitoring ON users (monitoring_enabled, subscription_end)",
+    ]),
+    (3, "promotion id for pending actions", [
+        "ALTER TABLE pending_actions ADD COLUMN action_id TEXT",
+    ]),
+    (4, "job queue state for pending actions", [
+        """DELETE FROM pending_actions WHERE id NOT IN
+           (SELECT MIN(id) FROM pending_actions
+            GROUP BY user_id, marketplace, COALESCE(action_id, ''), product_id, action_type)""",
+        "ALTER TABLE pending_actions ADD COLUMN state TEXT DEFAULT 'ready'",
+        "ALTER TABLE pending_actions ADD COLUMN attempts INTEGER DEFAULT 0",
+        "ALTER TABLE pending_actions ADD COLUMN lease_token TEXT",
+        "ALTER TABLE pending_actions ADD COLUMN last_error TEXT",
+        "ALTER TABLE pending_actions ADD COLUMN idempotency_key TEXT",
+        """UPDATE pending_actions SET idempotency_key =
+           user_id || ':' || marketplace || ':' || COALESCE(action_id, '') || ':' || product_id || ':' || action_type""",
+        "CREATE UNIQUE INDEX idx_pending_actions_key ON pending_actions (idempotency_key)",
+        "DROP INDEX idx_pending_actions_due",
+        "CREATE INDEX idx_pending_actions_due ON pending_actions (state, notification_time)",
+    ]),
+    (5, "staging table for price template uploads", [
+        """CREATE TABLE wb_prices_staging
+           (id INTEGER PRIMARY KEY, upload_id TEXT, user_id INTEGER, nmId TEXT, price REAL, discount REAL)""",
+        "CREATE INDEX idx_wb_prices_staging_upload ON wb_prices_staging (upload_id)",
+    ]),
+    (6, "marketplace column for price template", [
+        "ALTER TABLE wb_prices ADD COLUMN marketplace TEXT NOT NULL DEFAULT 'wb'",
+        "ALTER TABLE wb_prices_staging ADD COLUMN marketplace TEXT NOT NULL DEFAULT 'wb'",
+        "DROP INDEX idx_wb_prices_user",
+        "CREATE UNIQUE INDEX idx_wb_prices_user ON wb_prices (user_id, marketplace, nmId)",
+    ]),
+    (7, "promo price margin against the price template", [
+        "ALTER TABLE promo_snapshots ADD COLUMN margin REAL",
+        f"UPDATE promo_snapshots SET margin = {PROMO_MARGIN_SQL}",
+        "CREATE INDEX idx_promo_snapshots_margin ON promo_snapshots (user_id, margin, marketplace, action_id)",
+    ]),
+    (8, "daily rollups of the action log", [
+        """CREATE TABLE action_daily_stats
+           (id INTEGER PRIMARY KEY, user_id INTEGER, marketplace TEXT, day DATE, action_type TEXT, count INTEGER,
+            UNIQUE (user_id, day, marketplace, action_type))""",
+        """CREATE TABLE product_daily_stats
+           (id INTEGER PRIMARY KEY, user_id INTEGER, marketplace TEXT, product_id TEXT, day DATE, action_type TEXT,
+            count INTEGER, last_at DATETIME,
+            UNIQUE (user_id, marketplace, product_id, day, action_type))""",
+        *(f"""INSERT INTO action_daily_stats (user_id, marketplace, day, action_type, count)
+              SELECT user_id, '{marketplace}', DATE(date), action_type, COUNT(*) FROM {marketplace}_actions
+              WHERE date IS NOT NULL GROUP BY user_id, DATE(date), action_type"""
+          for marketplace in ('ozon', 'wb')),
+        *(f"""INSERT INTO product_daily_stats (user_id, marketplace, product_id, day, action_type, count, last_at)
+              SELECT user_id, '{marketplace}', product_id, DATE(date), action_type, COUNT(*), MAX(date)
+              FROM {marketplace}_actions
+              WHERE date IS NOT NULL GROUP BY user_id, product_id, DATE(date), action_type"""
+          for marketplace in ('ozon', 'wb')),
+    ]),
+    (9, "partial indexes for claimable and finished pending actions", [
+        # Условия совпадают с запросами claim_pending_actions и очистки: LIMIT читается прямо из индекса, без сортировки
+        "DROP INDEX idx_pending_actions_due",
+        """CREATE INDEX idx_pending_actions_claimable ON pending_actions (notification_time)
+           WHERE state IN ('ready', 'leased')""",
+        """CREATE INDEX idx_pending_actions_finished ON pending_actions (notification_time)
+           WHERE state IN ('done', 'dead')""",
+    ]),
+    (10, "partial index for queued pending actions of a promotion", [
+        # get_queued_product_ids читает только задачи своей акции, а не всю очередь
+        """CREATE INDEX idx_pending_actions_queued ON pending_actions (marketplace, action_id, action_type, user_id, product_id)
+           WHERE state IN ('ready', 'leased')""",
+    ]),
+]
+
+def run_migrations(cursor):
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    for migration_version, description, statements in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        logger.info(f"Applying database migration {migration_version}: {description}")
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.execute(f"PRAGMA user_version = {migration_version}")
+
+db.transaction(run_migrations)
+
+# 🔍 Проверка планов запросов: горячие запросы не должны сканировать таблицы целиком
+HOT_QUERIES = [
+    ("get_ignored_products",
+     "SELECT marketplace, product_id FROM ignored_products WHERE user_id = ?", (0,)),
+    ("claim_pending_actions",
+     """SELECT id, user_id, marketplace, product_id, action_type, action_id, attempts FROM pending_actions
+        WHERE state IN ('ready', 'leased') AND notification_time <= ? ORDER BY notification_time LIMIT ?""", ('', 1)),
+    ("get_queued_product_ids",
+     """SELECT product_id FROM pending_actions
+        WHERE state IN ('ready', 'leased') AND marketplace = ? AND action_id = ? AND action_type = ?
+          AND user_id IN (?, ?)""", ('', '', '', 0, 0)),
+    ("get_user_analytics",
+     """SELECT day, SUM(count) FROM action_daily_stats
+        WHERE user_id = ? AND day >= date('now', ?) GROUP BY day ORDER BY day""", (0, '-30 days')),
+    ("get_product_action_stats",
+     """SELECT action_type, SUM(count), MAX(last_at) FROM product_daily_stats
+        WHERE user_id = ? AND marketplace = ? AND product_id = ? AND day >= date('now', ?)
+        GROUP BY action_type""", (0, '', '', '-90 days')),
+    ("get_referral_count",
+     "SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (0,)),
+    ("scheduled_monitoring",
+     """SELECT chat_id, ozon_api_key, ozon_client_id, wb_api_key, auto_cancel_enabled
+        FROM users WHERE subscription_end >= date('now') AND monitoring_enabled = 1""", ()),
+]
+
+# Шаги плана без обращения к таблице, которые сканированием не считаются
+EXPECTED_SCAN_STEPS = ('SCAN CONSTANT ROW',)
+
+def check_query_plans():
+    # Возвращает список (имя запроса, шаг плана) для всех сканирований таблиц и индексов целиком
+    # и сортировок ORDER BY во временном дереве. "SCAN x" и "SCAN TABLE x" (SQLite до 3.36) ловятся одинаково
+    regressions = []
+    for name, sql, params in HOT_QUERIES:
+        for row in db.fetchall(f"EXPLAIN QUERY PLAN {sql}", params):
+            detail = row[-1]
+            if detail in EXPECTED_SCAN_STEPS:
+                continue
+            if detail.startswith('SCAN ') or detail.startswith('USE TEMP B-TREE FOR ORDER BY'):
+                regressions.append((name, detail))
+                logger.warning(f"Query plan regression in {name}: {detail}")
+    return regressions
+
+# 👤 Кэш строк пользователей: чтение через кэш, запись в users обязана вызвать invalidate
+USER_COLUMNS = ('chat_id', 'subscription_end', 'balance', 'ozon_api_key', 'ozon_client_id', 'wb_api_key',
+                'subscription_type', 'auto_cancel_enabled', 'monitoring_enabled')
+
+class UserCache:
+    def __init__(self, ttl=USER_CACHE_TTL, max_size=USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._rows = OrderedDict()  # chat_id -> (срок годности, строка или None)
+        self._invalidations = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    @instrumented('db_helper')
+    def get(self, chat_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._rows.get(chat_id)
+            if entry and entry[0] > now:
+                self._rows.move_to_end(chat_id)
+                self._stats['hits'] += 1
+                return entry[1]
+            self._stats['misses'] += 1
+            invalidations = self._invalidations
+
+        result = db.fetchone(f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE chat_id = ?", (chat_id,))
+        row = dict(zip(USER_COLUMNS, result)) if result else None
+
+        with self._lock:
+            # Строку, прочитанную до параллельной записи, не кэшируем
+            if invalidations == self._invalidations:
+                self._rows[chat_id] = (now + self.ttl, row)
+                self._rows.move_to_end(chat_id)
+                while len(self._rows) > self.max_size:
+                    self._rows.popitem(last=False)
+                    self._stats['evictions'] += 1
+        return row
+
+    def invalidate(self, chat_id):
+        with self._lock:
+            self._invalidations += 1
+            self._stats['invalidations'] += 1
+            self._rows.pop(chat_id, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._rows))
+
+user_cache = UserCache()
+
+def get_user(chat_id):
+    return user_cache.get(chat_id)
 
 # 🛠️ Функции для работы с базой данных
+@instrumented('db_helper')
 def add_user(chat_id):
     try:
-        cursor.execute("INSERT OR IGNORE INTO users (chat_id, subscription_end) VALUES (?, date('now', '+3 days'))", (chat_id,))
-        conn.commit()
+        db.execute("INSERT OR IGNORE INTO users (chat_id, subscription_end) VALUES (?, date('now', '+3 days'))", (chat_id,))
+        user_cache.invalidate(chat_id)
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
 
 def check_subscription(chat_id):
     try:
         # Проверка срока подписки
-        cursor.execute("SELECT subscription_end FROM users WHERE chat_id = ?", (chat_id,))
-        result = cursor.fetchone()
-        if result:
-            subscription_end = datetime.strptime(result[0], "%Y-%m-%d").date()
+        user = get_user(chat_id)
+        if user:
+            subscription_end = datetime.strptime(user['subscription_end'], "%Y-%m-%d").date()
             if subscription_end >= datetime.now().date():
                 return True
             else:
                 keyboard = InlineKeyboardMarkup()
                 keyboard.add(InlineKeyboardButton("🔄 Продлить подписку", callback_data="renew_subscription"))
-                bot.send_message(chat_id, "⚠️ Ваша подписка истекла. Пожалуйста, продлите ее для продолжения использования бота.", reply_markup=keyboard)
+                send_message(chat_id, "⚠️ Ваша подписка истекла. Пожалуйста, продлите ее для продолжения использования бота.", reply_markup=keyboard)
                 return False
         
         # Если подписки нет, предлагаем подписаться на канал
         keyboard = InlineKeyboardMarkup()
         keyboard.add(InlineKeyboardButton("📢 Подписаться на канал", url=f"https://t.me/{CHANNEL_ID[1:]}"))
         keyboard.add(InlineKeyboardButton("✅ Я подписался", callback_data="confirm_subscription"))
-        bot.send_message(chat_id, "🔔 Пожалуйста, подпишитесь на наш канал и нажмите кнопку 'Я подписался'.", reply_markup=keyboard)
+        send_message(chat_id, "🔔 Пожалуйста, подпишитесь на наш канал и нажмите кнопку 'Я подписался'.", reply_markup=keyboard)
         return True
     except Exception as e:
         logger.error(f"Error in check_subscription: {e}")
         return True
 
+# 🙈 Исключённые товары: ID хранятся строками, 'both' действует на оба маркетплейса
+IGNORED_MARKETPLACES = ('ozon', 'wb', 'both')
+
+def normalize_product_id(product_id):
+    return str(product_id).strip()
+
+class IgnoredProductsIndex:
+    # Множества исключений на пользователя; любая запись в ignored_products вызывает invalidate.
+    # Память ограничена и числом пользователей, и общим числом товаров во всех множествах
+    def __init__(self, max_size=USER_CACHE_SIZE, max_products=IGNORED_CACHE_PRODUCTS):
+        self.max_size = max_size
+        self.max_products = max_products
+        self._sets = OrderedDict()  # user_id -> {marketplace: frozenset(product_id)}
+        self._weights = {}  # user_id -> число товаров во всех множествах пользователя
+        self._products = 0
+        self._invalidations = 0
+        self._lock = threading.Lock()
+
+    @instrumented('db_helper')
+    def get(self, user_id, marketplace):
+        with self._lock:
+            entry = self._sets.get(user_id)
+            if entry is not None:
+                self._sets.move_to_end(user_id)
+                return entry.get(marketplace, entry['both'])
+            invalidations = self._invalidations
+
+        loaded = {name: set() for name in IGNORED_MARKETPLACES}
+        for row_marketplace, product_id in db.fetchall(
+                "SELECT marketplace, product_id FROM ignored_products WHERE user_id = ?", (user_id,)):
+            loaded.setdefault(row_marketplace, set()).add(normalize_product_id(product_id))
+        both = frozenset(loaded['both'])
+        entry = {name: both if name == 'both' else frozenset(products | both) for name, products in loaded.items()}
+
+        weight = sum(len(products) for products in entry.values())
+        with self._lock:
+            # Список больше всего бюджета не кэшируем: он читается из базы при каждом обращении
+            if invalidations == self._invalidations and weight <= self.max_products:
+                self._discard(user_id)
+                self._sets[user_id] = entry
+                self._weights[user_id] = weight
+                self._products += weight
+                while len(self._sets) > self.max_size or self._products > self.max_products:
+                    self._discard(next(iter(self._sets)))
+        return entry.get(marketplace, both)
+
+    def _discard(self, user_id):
+        if self._sets.pop(user_id, None) is not None:
+            self._products -= self._weights.pop(user_id)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._invalidations += 1
+            self._discard(user_id)
+
+ignored_index = IgnoredProductsIndex()
+
 def add_ignored_product(user_id, marketplace, product_id):
+    add_ignored_products(user_id, marketplace, [product_id])
+
+@instrumented('db_helper')
+def remove_ignored_product(user_id, marketplace, product_id):
     try:
-        cursor.execute("INSERT INTO ignored_products (user_id, marketplace, product_id) VALUES (?, ?, ?)",
-                       (user_id, marketplace, product_id))
-        conn.commit()
+        db.execute("DELETE FROM ignored_products WHERE user_id = ? AND marketplace = ? AND product_id = ?",
+                   (user_id, marketplace, normalize_product_id(product_id)))
+        ignored_index.invalidate(user_id)
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
 
-def remove_ignored_product(user_id, marketplace, product_id):
+def add_ignored_products(user_id, marketplace, product_ids):
+    return import_ignored_products(user_id, [(marketplace, product_id) for product_id in product_ids])
+
+@instrumented('db_helper')
+def import_ignored_products(user_id, rows):
+    # rows: пары (marketplace, product_id); весь список записывается одной транзакцией
     try:
-        cursor.execute("DELETE FROM ignored_products WHERE user_id = ? AND marketplace = ? AND product_id = ?",
-                       (user_id, marketplace, product_id))
-        conn.commit()
+        added = db.executemany("INSERT OR IGNORE INTO ignored_products (user_id, marketplace, product_id) VALUES (?, ?, ?)",
+                               [(user_id, marketplace, normalize_product_id(product_id)) for marketplace, product_id in rows])
+        ignored_index.invalidate(user_id)
+        return added
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
+        return 0
 
 def get_ignored_products(user_id, marketplace):
     try:
-        cursor.execute("SELECT product_id FROM ignored_products WHERE user_id = ? AND marketplace = ?",
-                       (user_id, marketplace))
-        return [row[0] for row in cursor.fetchall()]
+        return ignored_index.get(user_id, marketplace)
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
-        return []
-
+        return frozenset()
+
+def parse_ignored_products_csv(text):
+    # Колонки: product_id[,marketplace]; без маркетплейса исключение действует на оба
+    rows, errors = [], []
+    for line_number, record in enumerate(csv.reader(io.StringIO(text)), start=1):
+        if not record or not any(cell.strip() for cell in record):
+            continue
+        if line_number == 1 and record[0].strip().lower() == 'product_id':
+            continue
+        product_id = normalize_product_id(record[0])
+        marketplace = record[1].strip().lower() if len(record) > 1 and record[1].strip() else 'both'
+        if not product_id:
+            errors.append((line_number, "пустой ID товара"))
+        elif marketplace not in IGNORED_MARKETPLACES:
+            errors.append((line_number, f"неизвестный маркетплейс «{marketplace}»"))
+        else:
+            rows.append((marketplace, product_id))
+    return rows, errors
+
+@instrumented('db_helper')
+def export_ignored_products_csv(user_id):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['product_id', 'marketplace'])
+    writer.writerows(db.fetchall("""
+        SELECT product_id, marketplace FROM ignored_products
+        WHERE user_id = ? ORDER BY marketplace, product_id
+    """, (user_id,)))
+    return output.getvalue()
+
+@instrumented('db_helper')
 def add_promo_code(code, discount):
     try:
-        cursor.execute("INSERT INTO promo_codes (code, discount) VALUES (?, ?)", (code, discount))
-        conn.commit()
+        db.execute("INSERT INTO promo_codes (code, discount) VALUES (?, ?)", (code, discount))
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
 
+@instrumented('db_helper')
 def use_promo_code(code, user_id):
     try:
-        cursor.execute("SELECT discount, uses FROM promo_codes WHERE code = ?", (code,))
-        result = cursor.fetchone()
-        if result:
-            discount, uses = result
-            cursor.execute("UPDATE promo_codes SET uses = ? WHERE code = ?", (uses + 1, code))
-            cursor.execute("UPDATE users SET subscription_end = date(subscription_end, '+30 days') WHERE chat_id = ?", (user_id,))
-            conn.commit()
-            return discount
-        return None
+        def apply_promo_code(cursor):
+            result = cursor.execute("SELECT discount FROM promo_codes WHERE code = ?", (code,)).fetchone()
+            if result:
+                cursor.execute("UPDATE promo_codes SET uses = uses + 1 WHERE code = ?", (code,))
+                cursor.execute("UPDATE users SET subscription_end = date(subscription_end, '+30 days') WHERE chat_id = ?", (user_id,))
+                return result[0]
+            return None
+        discount = db.transaction(apply_promo_code)
+        user_cache.invalidate(user_id)
+        return discount
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
         return None
 
+@instrumented('db_helper')
 def add_referral(referrer_id, referred_id):
     try:
-        cursor.execute("INSERT INTO referrals (referrer_id, referred_id, date) VALUES (?, ?, date('now'))", (referrer_id, referred_id))
-        conn.commit()
+        db.execute("INSERT OR IGNORE INTO referrals (referrer_id, referred_id, date) VALUES (?, ?, date('now'))", (referrer_id, referred_id))
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
 
+@instrumented('db_helper')
 def get_referral_count(user_id):
     try:
-        cursor.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (user_id,))
-        return cursor.fetchone()[0]
+        return db.fetchone("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (user_id,))[0]
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
         return 0
 
+@instrumented('db_helper')
 def update_balance(user_id, amount):
     try:
-        cursor.execute("UPDATE users SET balance = balance + ? WHERE chat_id = ?", (amount, user_id))
-        conn.commit()
+        db.execute("UPDATE users SET balance = balance + ? WHERE chat_id = ?", (amount, user_id))
+        user_cache.invalidate(user_id)
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
 
-def get_user_analytics(user_id):
-    try:
-        cursor.execute("""
-            SELECT DATE(date) as day, COUNT(*) as count
-            FROM (
-                SELECT date FROM ozon_actions WHERE user_id = ?
-                UNION ALL
-                SELECT date FROM wb_actions WHERE user_id = ?
-            )
+# 📈 Журнал действий: сырые записи и дневные сводки обновляются в одной транзакции
+@instrumented('db_helper')
+def record_actions(cursor, user_id, marketplace, action_type, product_ids):
+    product_ids = [str(product_id) for product_id in product_ids]
+    if not product_ids:
+        return 0
+    cursor.executemany(f"""
+        INSERT INTO {marketplace}_actions (user_id, action_type, product_id, date)
+        VALUES (?, ?, ?, datetime('now'))
+    """, [(user_id, action_type, product_id) for product_id in product_ids])
+    cursor.execute("""
+        INSERT INTO action_daily_stats (user_id, marketplace, day, action_type, count)
+        VALUES (?, ?, date('now'), ?, ?)
+        ON CONFLICT (user_id, day, marketplace, action_type) DO UPDATE SET count = count + excluded.count
+    """, (user_id, marketplace, action_type, len(product_ids)))
+    cursor.executemany("""
+        INSERT INTO product_daily_stats (user_id, marketplace, product_id, day, action_type, count, last_at)
+        VALUES (?, ?, ?, date('now'), ?, 1, datetime('now'))
+        ON CONFLICT (user_id, marketplace, product_id, day, action_type) DO UPDATE SET
+            count = count + 1, last_at = excluded.last_at
+    """, [(user_id, marketplace, product_id, action_type) for product_id in product_ids])
+    return len(product_ids)
+
+@instrumented('db_helper')
+def get_user_analytics(user_id, days=ANALYTICS_WINDOW_DAYS):
+    # Последние days дней по возрастанию даты: [(день, количество действий)]
+    try:
+        return db.fetchall("""
+            SELECT day, SUM(count) FROM action_daily_stats
+            WHERE user_id = ? AND day >= date('now', ?)
             GROUP BY day
             ORDER BY day
-            LIMIT 30
-        """, (user_id, user_id))
-        return cursor.fetchall()
+        """, (user_id, f"-{days - 1} days"))
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
         return []
 
 def log_action(user_id, marketplace, action_type, product_id):
+    log_actions(user_id, marketplace, action_type, [product_id])
+
+@instrumented('db_helper')
+def log_actions(user_id, marketplace, action_type, product_ids):
     try:
-        table_name = f"{marketplace}_actions"
-        cursor.execute(f"""
-            INSERT INTO {table_name} (user_id, action_type, product_id, date)
-            VALUES (?, ?, ?, datetime('now'))
-        """, (user_id, action_type, product_id))
-        conn.commit()
+        db.transaction(lambda cursor: record_actions(cursor, user_id, marketplace, action_type, product_ids))
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
 
 def get_marketplace_credentials(user_id, marketplace):
     try:
-        if marketplace == 'ozon':
-            cursor.execute("SELECT ozon_api_key, ozon_client_id FROM users WHERE chat_id = ?", (user_id,))
-            result = cursor.fetchone()
-            if result:
-                return {'api_key': result[0], 'client_id': result[1]}
-        elif marketplace == 'wb':
-            cursor.execute("SELECT wb_api_key FROM users WHERE chat_id = ?", (user_id,))
-            result = cursor.fetchone()
-            if result:
-                return {'api_key': result[0]}
+        user = get_user(user_id)
+        if user and marketplace == 'ozon':
+            return {'api_key': user['ozon_api_key'], 'client_id': user['ozon_client_id']}
+        elif user and marketplace == 'wb':
+            return {'api_key': user['wb_api_key']}
         return None
     except sqlite3.Error as e:
         logger.error(f"Database error in get_marketplace_credentials: {e}")
         return None
 
+@instrumented('db_helper')
 def update_marketplace_credentials(user_id, marketplace, api_key, client_id=None):
     try:
         if marketplace == 'ozon':
-            cursor.execute("UPDATE users SET ozon_api_key = ?, ozon_client_id = ? WHERE chat_id = ?", 
-                           (api_key, client_id, user_id))
+            db.execute("UPDATE users SET ozon_api_key = ?, ozon_client_id = ? WHERE chat_id = ?", 
+                       (api_key, client_id, user_id))
         elif marketplace == 'wb':
-            cursor.execute("UPDATE users SET wb_api_key = ? WHERE chat_id = ?", 
-                           (api_key, user_id))
-        conn.commit()
+            db.execute("UPDATE users SET wb_api_key = ? WHERE chat_id = ?", 
+                       (api_key, user_id))
+        user_cache.invalidate(user_id)
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
 
-def add_pending_action(user_id, marketplace, product_id, action_type):
+# ⏳ Очередь отложенных действий: ready -> leased -> done | ready (повтор) | dead
+def db_time(moment):
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+def pending_action_key(user_id, marketplace, action_id, product_id, action_type):
+    return f"{user_id}:{marketplace}:{'' if action_id is None else action_id}:{product_id}:{action_type}"
+
+def add_pending_action(user_id, marketplace, product_id, action_type, action_id=None):
+    add_pending_actions(user_id, marketplace, [product_id], action_type, action_id)
+
+@instrumented('db_helper')
+def add_pending_actions(user_id, marketplace, product_ids, action_type, action_id=None):
+    try:
+        notification_time = db_time(datetime.now() + timedelta(seconds=PENDING_ACTION_DELAY))
+        action_id = None if action_id is None else str(action_id)
+        # Повторная постановка не трогает уже запланированную задачу и перезапускает только завершённые
+        db.executemany("""
+            INSERT INTO pending_actions (user_id, marketplace, product_id, action_type, notification_time, action_id,
+                                         state, attempts, idempotency_key)
+            VALUES (?, ?, ?, ?, ?, ?, 'ready', 0, ?)
+            ON CONFLICT (idempotency_key) DO UPDATE SET
+                state = 'ready', attempts = 0, lease_token = NULL, last_error = NULL,
+                notification_time = excluded.notification_time
+            WHERE pending_actions.state IN ('done', 'dead')
+        """, [(user_id, marketplace, str(product_id), action_type, notification_time, action_id,
+               pending_action_key(user_id, marketplace, action_id, product_id, action_type))
+              for product_id in product_ids])
+        pending_scheduler.schedule(datetime.strptime(notification_time, '%Y-%m-%d %H:%M:%S'))
+    except sqlite3.Error as e:
+        logger.error(f"Database error: {e}")
+
+@instrumented('db_helper')
+def get_queued_product_ids(user_ids, marketplace, action_id, action_type):
+    # Товары, уже стоящие в очереди у любого из этих чатов: повторно их не ставим
+    if not user_ids:
+        return set()
+    try:
+        placeholders = ', '.join('?' * len(user_ids))
+        rows = db.fetchall(f"""
+            SELECT product_id FROM pending_actions
+            WHERE state IN ('ready', 'leased') AND marketplace = ? AND action_id = ? AND action_type = ?
+              AND user_id IN ({placeholders})
+        """, (marketplace, str(action_id), action_type, *user_ids))
+        return {row[0] for row in rows}
+    except sqlite3.Error as e:
+        logger.error(f"Database error: {e}")
+        return set()
+
+@instrumented('db_helper')
+def next_pending_deadline():
+    try:
+        result = db.fetchone("SELECT MIN(notification_time) FROM pending_actions WHERE state IN ('ready', 'leased')")
+        return datetime.fromisoformat(result[0]) if result and result[0] else None
+    except (sqlite3.Error, ValueError) as e:
+        logger.error(f"Database error in next_pending_deadline: {e}")
+        return datetime.now() + timedelta(minutes=1)
+
+@instrumented('db_helper')
+def claim_pending_actions(limit=PENDING_CLAIM_LIMIT):
+    # Забирает готовые задачи в аренду; задачи с истёкшей арендой снова считаются готовыми
+    def claim(cursor):
+        now = datetime.now()
+        lease_token = uuid.uuid4().hex
+        jobs = cursor.execute("""
+            SELECT id, user_id, marketplace, product_id, action_type, action_id, attempts
+            FROM pending_actions
+            WHERE state IN ('ready', 'leased') AND notification_time <= ?
+            ORDER BY notification_time
+            LIMIT ?
+        """, (db_time(now), limit)).fetchall()
+        lease_until = db_time(now + timedelta(seconds=PENDING_LEASE_TIMEOUT))
+        cursor.executemany("""
+            UPDATE pending_actions
+            SET state = 'leased', lease_token = ?, notification_time = ?, attempts = attempts + 1
+            WHERE id = ?
+        """, [(lease_token, lease_until, job[0]) for job in jobs])
+        return lease_token, [job[:6] + ((job[6] or 0) + 1,) for job in jobs]
+
+    try:
+        return db.transaction(claim)
+    except sqlite3.Error as e:
+        logger.error(f"Database error in claim_pending_actions: {e}")
+        return None, []
+
+@instrumented('db_helper')
+def complete_pending_actions(cursor, lease_token, pending_ids):
+    cursor.executemany("""
+        UPDATE pending_actions SET state = 'done', lease_token = NULL, last_error = NULL
+        WHERE id = ? AND lease_token = ?
+    """, [(pending_id, lease_token) for pending_id in pending_ids])
+
+@instrumented('db_helper')
+def fail_pending_actions(cursor, lease_token, failed_jobs, error):
+    # failed_jobs: пары (id, attempts); возвращает количество задач, ушедших в dead
+    now = datetime.now()
+    retries, dead = [], []
+    for pending_id, attempts in failed_jobs:
+        if attempts >= PENDING_MAX_ATTEMPTS:
+            dead.append((error, pending_id, lease_token))
+        else:
+            retry_at = now + timedelta(seconds=PENDING_RETRY_BACKOFF * 2 ** (attempts - 1))
+            retries.append((db_time(retry_at), error, pending_id, lease_token))
+    cursor.executemany("""
+        UPDATE pending_actions SET state = 'ready', lease_token = NULL, notification_time = ?, last_error = ?
+        WHERE id = ? AND lease_token = ?
+    """, retries)
+    cursor.executemany("""
+        UPDATE pending_actions SET state = 'dead', lease_token = NULL, last_error = ?
+        WHERE id = ? AND lease_token = ?
+    """, dead)
+    return len(dead)
+
+@instrumented('db_helper')
+def set_auto_cancel(user_id, enabled):
     try:
-        notification_time = datetime.now() + timedelta(hours=1)
-        cursor.execute("""
-            INSERT INTO pending_actions (user_id, marketplace, product_id, action_type, notification_time)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, marketplace, product_id, action_type, notification_time))
-        conn.commit()
+        db.execute("UPDATE users SET auto_cancel_enabled = ? WHERE chat_id = ?", (1 if enabled else 0, user_id))
+        user_cache.invalidate(user_id)
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
 
-def get_pending_actions():
+def get_auto_cancel_status(user_id):
     try:
-        cursor.execute("""
-            SELECT id, user_id, marketplace, product_id, action_type
-            FROM pending_actions
-            WHERE notification_time <= datetime('now')
-        """)
-        return cursor.fetchall()
+        user = get_user(user_id)
+        return bool(user['auto_cancel_enabled']) if user else False
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
+        return False
+
+# 📸 Снимки товаров в акциях для отслеживания изменений
+def to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+@instrumented('db_helper')
+def get_promo_snapshot(user_id, marketplace, action_id, product_ids):
+    try:
+        product_ids = list(product_ids)
+        if not product_ids:
+            return {}
+        placeholders = ",".join("?" * len(product_ids))
+        rows = db.fetchall(f"""
+            SELECT product_id, price, discount_price, discount
+            FROM promo_snapshots
+            WHERE user_id = ? AND marketplace = ? AND action_id = ? AND product_id IN ({placeholders})
+        """, (user_id, marketplace, str(action_id), *product_ids))
+        return {row[0]: tuple(row[1:]) for row in rows}
+    except sqlite3.Error as e:
+        logger.error(f"Database error in get_promo_snapshot: {e}")
+        return {}
+
+@instrumented('db_helper')
+def save_promo_snapshot(user_id, marketplace, action_id, products):
+    # products: список кортежей (product_id, name, price, discount_price, discount, margin)
+    if not products:
+        return
+    try:
+        db.executemany("""
+            INSERT INTO promo_snapshots
+                (user_id, marketplace, action_id, product_id, name, price, discount_price, discount, margin, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
+            ON CONFLICT (user_id, marketplace, action_id, product_id) DO UPDATE SET
+                name = excluded.name, price = excluded.price, discount_price = excluded.discount_price,
+                discount = excluded.discount, margin = excluded.margin, updated_at = excluded.updated_at
+        """, [(user_id, marketplace, str(action_id), *product) for product in products])
+    except sqlite3.Error as e:
+        logger.error(f"Database error in save_promo_snapshot: {e}")
+
+@instrumented('db_helper')
+def prune_promo_snapshot(user_id, marketplace, action_id, seen_product_ids):
+    # Удаляем товары, которые пропали из акции
+    try:
+        rows = db.fetchall("SELECT product_id FROM promo_snapshots WHERE user_id = ? AND marketplace = ? AND action_id = ?",
+                       (user_id, marketplace, str(action_id)))
+        gone = [(user_id, marketplace, str(action_id), row[0]) for row in rows
+                if row[0] not in seen_product_ids]
+        if gone:
+            db.executemany("""
+                DELETE FROM promo_snapshots
+                WHERE user_id = ? AND marketplace = ? AND action_id = ? AND product_id = ?
+            """, gone)
+    except sqlite3.Error as e:
+        logger.error(f"Database error in prune_promo_snapshot: {e}")
+
+@instrumented('db_helper')
+def prune_promo_actions(user_id, marketplace, action_ids):
+    # Удаляем снимки акций, в которых пользователь больше не участвует
+    try:
+        active = {str(action_id) for action_id in action_ids}
+        rows = db.fetchall("SELECT DISTINCT action_id FROM promo_snapshots WHERE user_id = ? AND marketplace = ?",
+                       (user_id, marketplace))
+        gone = [(user_id, marketplace, row[0]) for row in rows if row[0] not in active]
+        if gone:
+            db.executemany("DELETE FROM promo_snapshots WHERE user_id = ? AND marketplace = ? AND action_id = ?", gone)
+    except sqlite3.Error as e:
+        logger.error(f"Database error in prune_promo_actions: {e}")
+
+@instrumented('db_helper')
+def refresh_promo_margins(user_id):
+    # После загрузки шаблона маржа пересчитывается по одной акции за транзакцию,
+    # чтобы не держать блокировку записи на весь каталог
+    try:
+        actions = db.fetchall("SELECT DISTINCT marketplace, action_id FROM promo_snapshots WHERE user_id = ?", (user_id,))
+        for marketplace, action_id in actions:
+            db.execute(f"""
+                UPDATE promo_snapshots SET margin = {PROMO_MARGIN_SQL}
+                WHERE user_id = ? AND marketplace = ? AND action_id = ?
+            """, (user_id, marketplace, action_id))
+    except sqlite3.Error as e:
+        logger.error(f"Database error in refresh_promo_margins: {e}")
+
+@instrumented('db_helper')
+def delete_promo_snapshot_products(user_id, marketplace, action_id, product_ids):
+    try:
+        db.executemany("""
+            DELETE FROM promo_snapshots
+            WHERE user_id = ? AND marketplace = ? AND action_id = ? AND product_id = ?
+        """, [(user_id, marketplace, str(action_id), str(product_id)) for product_id in product_ids])
+    except sqlite3.Error as e:
+        logger.error(f"Database error in delete_promo_snapshot_products: {e}")
+
+@instrumented('db_helper')
+def get_product_promotions(user_id, marketplace, product_id):
+    # Акции, в которых товар был замечен последним мониторингом
+    try:
+        return db.fetchall("""
+            SELECT action_id, name, price, discount_price, discount, updated_at
+            FROM promo_snapshots
+            WHERE user_id = ? AND marketplace = ? AND product_id = ?
+        """, (user_id, marketplace, str(product_id)))
+    except sqlite3.Error as e:
+        logger.error(f"Database error in get_product_promotions: {e}")
         return []
 
-def remove_pending_action(action_id):
+@instrumented('db_helper')
+def get_product_action_stats(user_id, marketplace, product_id, days=PRODUCT_STATS_WINDOW_DAYS):
+    # [(тип действия, количество за окно, время последнего действия)], последние действия первыми
     try:
-        cursor.execute("DELETE FROM pending_actions WHERE id = ?", (action_id,))
-        conn.commit()
+        return db.fetchall("""
+            SELECT action_type, SUM(count), MAX(last_at) FROM product_daily_stats
+            WHERE user_id = ? AND marketplace = ? AND product_id = ? AND day >= date('now', ?)
+            GROUP BY action_type
+            ORDER BY 3 DESC
+        """, (user_id, marketplace, str(product_id), f"-{days - 1} days"))
     except sqlite3.Error as e:
-        logger.error(f"Database error: {e}")
+        logger.error(f"Database error in get_product_action_stats: {e}")
+        return []
 
-def set_auto_cancel(user_id, enabled):
+# Товары из исключений (в том числе общих для обоих маркетплейсов) в сводку не попадают,
+# как и товары, чья цена в акции не ниже порога из шаблона цен
+PROMO_SNAPSHOT_VISIBLE = """
+    FROM promo_snapshots s
+    WHERE s.user_id = ? AND s.marketplace = ? AND s.action_id = ?
+      AND NOT EXISTS (
+          SELECT 1 FROM ignored_products i
+          WHERE i.user_id = s.user_id AND i.marketplace IN (s.marketplace, 'both') AND i.product_id = s.product_id
+      )
+      AND (s.margin IS NULL OR s.margin < 0)
+"""
+
+@instrumented('db_helper')
+def count_promo_snapshot(user_id, marketplace, action_id):
+    try:
+        return db.fetchone(f"SELECT COUNT(*) {PROMO_SNAPSHOT_VISIBLE}", (user_id, marketplace, str(action_id)))[0]
+    except sqlite3.Error as e:
+        logger.error(f"Database error in count_promo_snapshot: {e}")
+        return 0
+
+@instrumented('db_helper')
+def get_promo_snapshot_page(user_id, marketplace, action_id, offset, limit):
     try:
-        cursor.execute("UPDATE users SET auto_cancel_enabled = ? WHERE chat_id = ?", (1 if enabled else 0, user_id))
-        conn.commit()
+        return db.fetchall(f"""
+            SELECT s.product_id, s.name, s.price, s.discount_price, s.discount
+            {PROMO_SNAPSHOT_VISIBLE}
+            ORDER BY s.id
+            LIMIT ? OFFSET ?
+        """, (user_id, marketplace, str(action_id), limit, offset))
     except sqlite3.Error as e:
-        logger.error(f"Database error: {e}")
+        logger.error(f"Database error in get_promo_snapshot_page: {e}")
+        return []
 
-def get_auto_cancel_status(user_id):
+@instrumented('db_helper')
+def get_promo_snapshot_product_ids(user_id, marketplace, action_id):
     try:
-        cursor.execute("SELECT auto_cancel_enabled FROM users WHERE chat_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return bool(result[0]) if result else False
+        rows = db.fetchall(f"SELECT s.product_id {PROMO_SNAPSHOT_VISIBLE}", (user_id, marketplace, str(action_id)))
+        return [row[0] for row in rows]
     except sqlite3.Error as e:
-        logger.error(f"Database error: {e}")
-        return False
+        logger.error(f"Database error in get_promo_snapshot_product_ids: {e}")
+        return []
+
+@instrumented('db_helper')
+def get_promotion_title(user_id, marketplace, action_id):
+    try:
+        if marketplace == 'ozon':
+            result = db.fetchone("SELECT title FROM ozon_promotions WHERE user_id = ? AND action_id = ?", (user_id, action_id))
+        else:
+            result = db.fetchone("SELECT title FROM wb_promotions WHERE user_id = ? AND promotion_id = ?", (user_id, action_id))
+        return result[0] if result else str(action_id)
+    except sqlite3.Error as e:
+        logger.error(f"Database error in get_promotion_title: {e}")
+        return str(action_id)
+
+# Цена в акции и порог шаблона восстанавливаются из снимка: порог = цена в акции - маржа
+PROMO_SIMULATION_ROW = """
+    SELECT marketplace, action_id, product_id, name, price,
+           COALESCE(discount_price, price * (100 - discount) / 100.0) AS promo_price,
+           COALESCE(discount_price, price * (100 - discount) / 100.0) - margin, margin
+    FROM promo_snapshots
+"""
+
+@instrumented('db_helper')
+def simulate_promotions(user_id, limit=SIMULATION_TOP_SIZE):
+    # Маржа — цена в акции минус порог из шаблона; отрицательная означает продажу в убыток
+    try:
+        promotions = db.fetchall("""
+            SELECT marketplace, action_id, COUNT(*), SUM(margin < 0), COALESCE(SUM(MIN(margin, 0)), 0)
+            FROM promo_snapshots
+            WHERE user_id = ? AND margin IS NOT NULL
+            GROUP BY marketplace, action_id
+            ORDER BY 5, 4 DESC
+        """, (user_id,))
+        losers = db.fetchall(f"""
+            {PROMO_SIMULATION_ROW}
+            WHERE user_id = ? AND margin < 0
+            ORDER BY margin
+            LIMIT ?
+        """, (user_id, limit))
+        uncovered = db.fetchone("SELECT COUNT(*) FROM promo_snapshots WHERE user_id = ? AND margin IS NULL",
+                                (user_id,))[0]
+        return {'promotions': promotions, 'losers': losers, 'uncovered': uncovered}
+    except sqlite3.Error as e:
+        logger.error(f"Database error in simulate_promotions: {e}")
+        return None
+
+@instrumented('db_helper')
+def export_promo_simulation_csv(user_id, limit=SIMULATION_EXPORT_LIMIT):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['marketplace', 'action_id', 'promotion', 'product_id', 'name', 'price', 'promo_price',
+                     'min_price', 'margin', 'margin_percent'])
+    titles = {}
+    for marketplace, action_id, product_id, name, price, promo, floor, margin in db.fetchall(f"""
+            {PROMO_SIMULATION_ROW}
+            WHERE user_id = ? AND margin IS NOT NULL
+            ORDER BY margin
+            LIMIT ?
+        """, (user_id, limit)):
+        if (marketplace, action_id) not in titles:
+            titles[(marketplace, action_id)] = get_promotion_title(user_id, marketplace, action_id)
+        writer.writerow([marketplace, action_id, titles[(marketplace, action_id)], product_id, name, price,
+                         round(promo, 2), round(floor, 2), round(margin, 2),
+                         round(margin / floor * 100, 1) if floor else ''])
+    return output.getvalue()
+
+# 🌐 HTTP-клиент с пулом соединений для API маркетплейсов
+class CircuitOpenError(requests.RequestException):
+    pass
+
+class CircuitBreaker:
+    # closed -> open после серии сбоев -> half_open (один пробный запрос) -> closed | open
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    logger.warning(f"Circuit for {self.name} opened after {self.failures} failures")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+def credential_fingerprint(*parts):
+    # Ключи API не храним в открытом виде в словарях и логах
+    return hashlib.sha1(":".join(str(part) for part in parts).encode('utf-8')).hexdigest()[:16]
+
+class MarketplaceClient:
+    def __init__(self, connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT,
+                 pool_size=HTTP_POOL_SIZE, max_retries=HTTP_MAX_RETRIES, retry_backoff=HTTP_RETRY_BACKOFF,
+                 concurrency=MARKETPLACE_CONCURRENCY):
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._retries = {}
+        self._throttled = {}
+        self._buckets = {}
+        self._breakers = {}
+        # Ограничиваем число одновременных запросов к одному маркетплейсу
+        self._slots = {name: threading.BoundedSemaphore(limit) for name, limit in concurrency.items()}
+
+    def _session(self, host):
+        # Отдельная сессия и пул keep-alive соединений на каждый хост
+        with self._lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount(f"https://{host}", adapter)
+                session.mount(f"http://{host}", adapter)
+                self._sessions[host] = (session, adapter)
+                self._requests[host] = 0
+                self._retries[host] = 0
+                self._throttled[host] = 0
+            return self._sessions[host][0]
+
+    def _breaker(self, host):
+        # Один предохранитель на маркетплейс, даже если у него несколько хостов
+        name = MARKETPLACE_HOSTS.get(host, host)
+        with self._lock:
+            if name not in self._breakers:
+                self._breakers[name] = CircuitBreaker(name)
+            return self._breakers[name]
+
+    def _bucket(self, host, path, headers):
+        limits = MARKETPLACE_RATE_LIMITS.get(host)
+        if not limits or not headers:
+            return None
+        rate, burst = limits.get(path, limits[''])
+        key = (credential_fingerprint(headers.get('Client-Id'), headers.get('Api-Key'), headers.get('Authorization')),
+               host, path)
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(rate, burst)
+            return self._buckets[key]
+
+    def _throttle(self, host, bucket):
+        # Ждём свой токен: лимит общий для мониторинга и ручных действий пользователя
+        delay = bucket.try_acquire()
+        if delay:
+            with self._lock:
+                self._throttled[host] += 1
+        while delay:
+            time.sleep(delay)
+            delay = bucket.try_acquire()
+
+    def _backoff_delay(self, attempt, response):
+        delay = random.uniform(0, self.retry_backoff * 2 ** attempt)
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        return delay
+
+    def request(self, method, url, idempotent=None, **kwargs):
+        if idempotent is None:
+            idempotent = method.upper() in ('GET', 'HEAD')
+        kwargs.setdefault('timeout', self.timeout)
+        parts = urlsplit(url)
+        host = parts.netloc
+        session = self._session(host)
+        breaker = self._breaker(host)
+        bucket = self._bucket(host, parts.path, kwargs.get('headers'))
+        slot = self._slots.get(MARKETPLACE_HOSTS.get(host))
+
+        attempt = 0
+        while True:
+            response = None
+            if not breaker.allow():
+                raise CircuitOpenError(f"Circuit open for {MARKETPLACE_HOSTS.get(host, host)}, skipping {method} {url}")
+            # Слот занимаем только после получения токена и только на время самого запроса:
+            # ожидание лимита и пауза перед повтором не держат слоты других запросов
+            if bucket:
+                self._throttle(host, bucket)
+            with self._lock:
+                self._requests[host] += 1
+            if slot:
+                slot.acquire()
+            try:
+                response = session.request(method, url, **kwargs)
+                metrics.inc('marketplace_http_responses_total', marketplace=MARKETPLACE_HOSTS.get(host, host),
+                            status=response.status_code)
+                if response.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if not (idempotent and response.status_code in HTTP_RETRY_STATUSES and attempt < self.max_retries):
+                    return response
+            except (requests.ConnectionError, requests.Timeout):
+                breaker.record_failure()
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+            except requests.RequestException:
+                breaker.record_failure()
+                raise
+            finally:
+                if slot:
+                    slot.release()
+            delay = self._backoff_delay(attempt, response)
+            if bucket and response is not None and response.status_code == 429:
+                bucket.block(delay)
+            attempt += 1
+            with self._lock:
+                self._retries[host] += 1
+            logger.warning(f"Retrying {method} {url} in {delay:.1f}s (attempt {attempt}/{self.max_retries})")
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self._sessions.items())
+            stats = {host: {'requests': self._requests[host], 'retries': self._retries[host],
+                            'throttled': self._throttled[host]} for host, _ in sessions}
+            circuits = {name: breaker.state for name, breaker in self._breakers.items()}
+        for host, (_, adapter) in sessions:
+            pools = adapter.poolmanager.pools
+            new_connections = 0
+            pooled_requests = 0
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    new_connections += pool.num_connections
+                    pooled_requests += pool.num_requests
+            stats[host]['new_connections'] = new_connections
+            stats[host]['reused_connections'] = max(pooled_requests - new_connections, 0)
+            stats[host]['circuit'] = circuits.get(MARKETPLACE_HOSTS.get(host, host), 'closed')
+        return stats
+
+marketplace_client = MarketplaceClient()
 
 # 🌐 Функции для работы с API маркетплейсов
+@instrumented('marketplace_api')
 def get_ozon_actions(api_key, client_id):
     url = "https://api-seller.ozon.ru/v1/actions"
     headers = {
@@ -282,13 +1647,14 @@ def get_ozon_actions(api_key, client_id):
         "Content-Type": "application/json"
     }
     try:
-        response = requests.get(url, headers=headers)
+        response = marketplace_client.get(url, headers=headers)
         response.raise_for_status()
         return response.json().get('result', [])
     except requests.RequestException as e:
         logger.error(f"Ozon API error in get_ozon_actions: {e}")
-        return []
+        return None
 
+@instrumented('marketplace_api')
 def get_wb_actions(api_key):
     url = "https://suppliers-api.wildberries.ru/api/v1/calendar/promotions"
     headers = {
@@ -296,13 +1662,14 @@ def get_wb_actions(api_key):
         "Content-Type": "application/json"
     }
     try:
-        response = requests.get(url, headers=headers)
+        response = marketplace_client.get(url, headers=headers)
         response.raise_for_status()
         return response.json().get('data', [])
     except requests.RequestException as e:
         logger.error(f"Wildberries API error in get_wb_actions: {e}")
-        return []
+        return None
     
+@instrumented('marketplace_api')
 def get_ozon_promo_products(api_key, client_id, action_id, offset=0, limit=100):
     url = "https://api-seller.ozon.ru/v1/actions/products"
     headers = {
@@ -316,7 +1683,7 @@ def get_ozon_promo_products(api_key, client_id, action_id, offset=0, limit=100):
         "offset": offset
     }
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = marketplace_client.post(url, headers=headers, json=payload, idempotent=True)
         response.raise_for_status()
         return response.json().get('result', {})
     except requests.exceptions.HTTPError as e:
@@ -330,7 +1697,12 @@ def get_ozon_promo_products(api_key, client_id, action_id, offset=0, limit=100):
         logger.error(f"Ozon API request failed: {e}")
         return None
 
-def remove_ozon_product_from_promo(api_key, client_id, product_id):
+def remove_ozon_product_from_promo(api_key, client_id, product_id, action_id=None):
+    return remove_ozon_products_from_promo(api_key, client_id, action_id, [product_id])
+
+@instrumented('marketplace_api')
+def remove_ozon_products_from_promo(api_key, client_id, action_id, product_ids):
+    # Возвращает товары, снятие которых Ozon подтвердил в result.product_ids; отклонённые в ответ не попадают
     url = "https://api-seller.ozon.ru/v1/actions/products/deactivate"
     headers = {
         "Client-Id": client_id,
@@ -338,16 +1710,24 @@ def remove_ozon_product_from_promo(api_key, client_id, product_id):
         "Content-Type": "application/json"
     }
     payload = {
-        "product_ids": [product_id]
+        "product_ids": [int(product_id) for product_id in product_ids]
     }
+    if action_id is not None:
+        payload["action_id"] = int(action_id)
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = marketplace_client.post(url, headers=headers, json=payload)
         response.raise_for_status()
-        return True
-    except requests.RequestException as e:
+        result = response.json().get('result') or {}
+        confirmed = {int(product_id) for product_id in result.get('product_ids') or []}
+        for rejected in result.get('rejected') or []:
+            logger.warning(f"Ozon rejected removal of product {rejected.get('product_id')} "
+                           f"from action {action_id}: {rejected.get('reason')}")
+        return [product_id for product_id in product_ids if int(product_id) in confirmed]
+    except (requests.RequestException, ValueError) as e:
         logger.error(f"Ozon API error: {e}")
-        return False
+        return []
 
+@instrumented('marketplace_api')
 def get_wb_promo_products(api_key, promotion_id, in_action=True, offset=0, limit=1000):
     url = "https://suppliers-api.wildberries.ru/api/v1/calendar/products"
     headers = {
@@ -361,13 +1741,50 @@ def get_wb_promo_products(api_key, promotion_id, in_action=True, offset=0, limit
         "promotionId": promotion_id
     }
     try:
-        response = requests.get(url, headers=headers, params=params)
+        response = marketplace_client.get(url, headers=headers, params=params)
         response.raise_for_status()
         return response.json().get('data', [])
     except requests.RequestException as e:
         logger.error(f"Wildberries API error: {e}")
         return None
 
+# 📄 Постраничная загрузка товаров акций
+page_prefetch_executor = ThreadPoolExecutor(max_workers=MONITORING_FETCH_WORKERS, thread_name_prefix="page-prefetch")
+
+def iter_pages(fetch_page, page_size):
+    # Следующая страница загружается в фоне, пока обрабатывается текущая,
+    # поэтому в памяти одновременно находится не больше двух страниц
+    offset = 0
+    future = page_prefetch_executor.submit(fetch_page, offset, page_size)
+    try:
+        while future is not None:
+            page = future.result()
+            if not page:
+                return
+            offset += page_size
+            future = page_prefetch_executor.submit(fetch_page, offset, page_size) if len(page) >= page_size else None
+            yield page
+    finally:
+        if future is not None:
+            future.cancel()
+
+def iter_ozon_promo_products(api_key, client_id, action_id, page_size=OZON_PAGE_SIZE):
+    def fetch_page(offset, limit):
+        result = get_ozon_promo_products(api_key, client_id, action_id, offset, limit)
+        if result is None:
+            raise requests.RequestException(f"Failed to fetch Ozon action {action_id} products at offset {offset}")
+        return result.get('products') or result.get('items') or []
+    return iter_pages(fetch_page, page_size)
+
+def iter_wb_promo_products(api_key, promotion_id, page_size=WB_PAGE_SIZE):
+    def fetch_page(offset, limit):
+        result = get_wb_promo_products(api_key, promotion_id, True, offset, limit)
+        if result is None:
+            raise requests.RequestException(f"Failed to fetch Wildberries promotion {promotion_id} products at offset {offset}")
+        return result
+    return iter_pages(fetch_page, page_size)
+
+@instrumented('marketplace_api')
 def update_wb_product_discount(api_key, product_data):
     url = "https://suppliers-api.wildberries.ru/api/v1/calendar/prices"
     headers = {
@@ -375,7 +1792,7 @@ def update_wb_product_discount(api_key, product_data):
         "Content-Type": "application/json"
     }
     try:
-        response = requests.post(url, headers=headers, json=product_data)
+        response = marketplace_client.post(url, headers=headers, json=product_data)
         response.raise_for_status()
         return True
     except requests.RequestException as e:
@@ -383,77 +1800,315 @@ def update_wb_product_discount(api_key, product_data):
         return False
 
 # 🔄 Функции для обновления информации об акциях
+# Хэш последнего синхронизированного набора строк по (таблица, пользователь)
+sync_hashes = {}
+sync_hashes_lock = threading.Lock()
+
+@instrumented('db_helper')
+def sync_user_rows(table, key_column, value_columns, user_id, rows):
+    # rows: кортежи (ключ, *значения); возвращает True, если данные в таблице изменились
+    digest = hashlib.sha1(repr(sorted(rows, key=repr)).encode('utf-8')).hexdigest()
+    with sync_hashes_lock:
+        if sync_hashes.get((table, user_id)) == digest:
+            return False
+
+    columns = ", ".join([key_column] + value_columns)
+    placeholders = ", ".join("?" * (len(value_columns) + 2))
+    updates = ", ".join(f"{column} = excluded.{column}" for column in value_columns)
+    differs = " OR ".join(f"{column} IS NOT excluded.{column}" for column in value_columns)
+
+    def sync(cursor):
+        existing = {row[0] for row in cursor.execute(f"SELECT {key_column} FROM {table} WHERE user_id = ?", (user_id,))}
+        stale = existing - {row[0] for row in rows}
+        cursor.executemany(f"DELETE FROM {table} WHERE user_id = ? AND {key_column} = ?",
+                           [(user_id, key) for key in stale])
+        deleted = len(stale)
+        cursor.executemany(f'''INSERT INTO {table} (user_id, {columns}) VALUES ({placeholders})
+                               ON CONFLICT (user_id, {key_column}) DO UPDATE SET {updates}
+                               WHERE {differs}''',
+                           [(user_id, *row) for row in rows])
+        return deleted + max(cursor.rowcount, 0)
+
+    changes = db.transaction(sync)
+    with sync_hashes_lock:
+        sync_hashes[(table, user_id)] = digest
+    return changes > 0
+
 def update_ozon_actions(user_id, actions):
     try:
-        cursor.execute("DELETE FROM ozon_promotions WHERE user_id = ?", (user_id,))
-        for action in actions:
-            cursor.execute('''INSERT INTO ozon_promotions 
-                              (user_id, action_id, title, action_type, date_start, date_end, is_participating) 
-                              VALUES (?, ?, ?, ?, ?, ?, ?)''', 
-                           (user_id, action['id'], action['title'], action['action_type'],
-                            action['date_start'], action['date_end'], int(action['is_participating'])))
-        conn.commit()
+        rows = [(action['id'], action['title'], action['action_type'], action['date_start'],
+                 action['date_end'], int(action['is_participating'])) for action in actions]
+        return sync_user_rows('ozon_promotions', 'action_id',
+                              ['title', 'action_type', 'date_start', 'date_end', 'is_participating'],
+                              user_id, rows)
     except sqlite3.Error as e:
         logger.error(f"Database error in update_ozon_actions: {e}")
+        return False
 
 def update_wb_actions(user_id, actions):
     try:
-        cursor.execute("DELETE FROM wb_promotions WHERE user_id = ?", (user_id,))
-        for action in actions:
-            cursor.execute('''INSERT INTO wb_promotions 
-                              (user_id, promotion_id, title, date_start, date_end, is_participating) 
-                              VALUES (?, ?, ?, ?, ?, ?)''', 
-                           (user_id, action['id'], action['name'], action['startDate'],
-                            action['endDate'], int(action['isActive'])))
-        conn.commit()
+        rows = [(action['id'], action['name'], action['startDate'], action['endDate'],
+                 int(action['isActive'])) for action in actions]
+        return sync_user_rows('wb_promotions', 'promotion_id',
+                              ['title', 'date_start', 'date_end', 'is_participating'],
+                              user_id, rows)
     except sqlite3.Error as e:
         logger.error(f"Database error in update_wb_actions: {e}")
+        return False
 
 # 📊 Функция для обработки шаблона цен Wildberries
+PRICE_TEMPLATE_COLUMNS = ('nmId', 'price', 'discount')
+
+def stream_telegram_file(file_path):
+    # Файл читается из сети построчно, без загрузки целиком в память
+    url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
+    response = requests.get(url, stream=True, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    response.raise_for_status()
+    response.raw.decode_content = True
+    return response, io.TextIOWrapper(response.raw, encoding='utf-8-sig', newline='')
+
+def parse_price_row(row):
+    marketplace = (row.get('marketplace') or 'wb').strip().lower() or 'wb'
+    if marketplace not in PRICE_TEMPLATE_MARKETPLACES:
+        raise ValueError(f"неизвестный маркетплейс «{marketplace}»")
+    nm_id = (row.get('nmId') or '').strip()
+    if not nm_id.isdigit():
+        raise ValueError(f"некорректный nmId «{nm_id}»")
+    try:
+        price = float((row.get('price') or '').replace(',', '.'))
+        discount = float((row.get('discount') or '').replace(',', '.'))
+    except ValueError:
+        raise ValueError("цена и скидка должны быть числами")
+    if price <= 0:
+        raise ValueError("цена должна быть больше нуля")
+    if not 0 <= discount < 100:
+        raise ValueError("скидка должна быть от 0 до 99")
+    return marketplace, nm_id, price, discount
+
+class PriceFloorIndex:
+    # Пороги цен из шаблона на пользователя: {marketplace: {product_id: минимальная цена}}
+    def __init__(self, max_size=PRICE_FLOOR_CACHE_SIZE):
+        self.max_size = max_size
+        self._floors = OrderedDict()
+        self._invalidations = 0
+        self._lock = threading.Lock()
+
+    @instrumented('db_helper')
+    def get(self, user_id, marketplace):
+        with self._lock:
+            entry = self._floors.get(user_id)
+            if entry is not None:
+                self._floors.move_to_end(user_id)
+                return entry.get(marketplace, {})
+            invalidations = self._invalidations
+
+        entry = {}
+        for row_marketplace, product_id, floor in db.fetchall(
+                "SELECT marketplace, nmId, price * (100 - discount) / 100.0 FROM wb_prices WHERE user_id = ?", (user_id,)):
+            entry.setdefault(row_marketplace, {})[product_id] = floor
+
+        with self._lock:
+            if invalidations == self._invalidations:
+                self._floors[user_id] = entry
+                while len(self._floors) > self.max_size:
+                    self._floors.popitem(last=False)
+        return entry.get(marketplace, {})
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._invalidations += 1
+            self._floors.pop(user_id, None)
+
+price_floor_index = PriceFloorIndex()
+
+def get_price_floors(user_id, marketplace):
+    try:
+        return price_floor_index.get(user_id, marketplace)
+    except sqlite3.Error as e:
+        logger.error(f"Database error in get_price_floors: {e}")
+        return {}
+
+price_upload_locks = {}
+price_upload_locks_guard = threading.Lock()
+
+def get_price_upload_lock(user_id):
+    with price_upload_locks_guard:
+        lock = price_upload_locks.get(user_id)
+        if lock is None:
+            lock = price_upload_locks[user_id] = threading.Lock()
+        return lock
+
+@instrumented('db_helper')
+def ingest_price_template(user_id, lines):
+    # Загрузки одного пользователя идут по очереди: иначе очистка и замена шаблона одной
+    # загрузки задели бы строки другой
+    with get_price_upload_lock(user_id):
+        return ingest_price_rows(user_id, lines)
+
+def ingest_price_rows(user_id, lines):
+    # Валидные строки пачками пишутся во временную таблицу, затем одной транзакцией заменяют шаблон
+    started = time.monotonic()
+    upload_id = uuid.uuid4().hex
+    # staged — корректные строки файла, rows — сохранённые товары (повторы nmId схлопываются), duplicates — разница
+    result = {'staged': 0, 'rows': 0, 'duplicates': 0, 'errors': [], 'error_count': 0, 'applied': False}
+    # Под блокировкой пользователя здесь могут остаться только строки прерванных прошлых загрузок
+    db.execute("DELETE FROM wb_prices_staging WHERE user_id = ?", (user_id,))
+
+    def record_error(line_number, error):
+        result['error_count'] += 1
+        if len(result['errors']) < PRICE_TEMPLATE_MAX_ERRORS:
+            result['errors'].append((line_number, error))
+
+    reader = csv.DictReader(lines)
+    missing = [column for column in PRICE_TEMPLATE_COLUMNS if column not in (reader.fieldnames or [])]
+    if missing:
+        record_error(1, f"нет колонок: {', '.join(missing)}")
+    else:
+        chunk = []
+        for row in reader:
+            try:
+                chunk.append((upload_id, user_id) + parse_price_row(row))
+            except ValueError as e:
+                record_error(reader.line_num, str(e))
+                continue
+            if len(chunk) >= PRICE_TEMPLATE_CHUNK_SIZE:
+                result['staged'] += db.executemany("""
+                    INSERT INTO wb_prices_staging (upload_id, user_id, marketplace, nmId, price, discount)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, chunk)
+                chunk = []
+        if chunk:
+            result['staged'] += db.executemany("""
+                INSERT INTO wb_prices_staging (upload_id, user_id, marketplace, nmId, price, discount)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, chunk)
+
+    def swap(cursor):
+        if result['staged']:
+            cursor.execute("DELETE FROM wb_prices WHERE user_id = ?", (user_id,))
+            # Повторяющиеся nmId: побеждает последняя строка файла
+            cursor.execute("""
+                INSERT OR REPLACE INTO wb_prices (user_id, marketplace, nmId, price, discount)
+                SELECT user_id, marketplace, nmId, price, discount FROM wb_prices_staging
+                WHERE upload_id = ? ORDER BY id
+            """, (upload_id,))
+            result['rows'] = cursor.execute("SELECT COUNT(*) FROM wb_prices WHERE user_id = ?", (user_id,)).fetchone()[0]
+            result['duplicates'] = result['staged'] - result['rows']
+        cursor.execute("DELETE FROM wb_prices_staging WHERE upload_id = ?", (upload_id,))
+
+    db.transaction(swap)
+    if result['rows']:
+        result['applied'] = True
+        price_floor_index.invalidate(user_id)
+    result['elapsed'] = time.monotonic() - started
+    if result['applied']:
+        refresh_promo_margins(user_id)
+    return result
+
+@instrumented('bot_handler')
 def process_price_template(message):
     try:
-        if message.document:
-            file_info = bot.get_file(message.document.file_id)
-            downloaded_file = bot.download_file(file_info.file_path)
-            csv_file = io.StringIO(downloaded_file.decode('utf-8'))
-            csv_reader = csv.DictReader(csv_file)
-            
-            price_data = []
-            for row in csv_reader:
-                price_data.append({
-                    'nmId': row['nmId'],
-                    'price': float(row['price']),
-                    'discount': float(row['discount'])
-                })
-            
-            update_wb_prices(message.chat.id, price_data)
-            
-            success_text = (
+        if not message.document:
+            reply_to(message, "❌ Пожалуйста, отправьте файл в формате CSV.")
+            return
+
+        file_info = bot.get_file(message.document.file_id)
+        response, lines = stream_telegram_file(file_info.file_path)
+        try:
+            result = ingest_price_template(message.chat.id, lines)
+        finally:
+            response.close()
+
+        processed = result['staged'] + result['error_count']
+        speed = processed / max(result['elapsed'], 1e-9)
+        if result['applied']:
+            result_text = (
                 "✅ Шаблон цен успешно загружен и обработан!\n\n"
-                "📊 Теперь бот будет использовать эти цены при работе с товарами Wildberries.\n"
-                f"📦 Обработано товаров: {len(price_data)}\n"
+                "📊 Теперь бот будет сообщать только о товарах, чья цена в акции ниже цены из шаблона с учётом скидки.\n"
+                f"📦 Сохранено товаров: {result['rows']}\n"
+                + (f"🔁 Повторяющихся строк (учтена последняя): {result['duplicates']}\n" if result['duplicates'] else "")
+                + f"⏱ Время загрузки: {result['elapsed']:.1f} с ({speed:.0f} строк/с)\n"
                 "🔄 Вы всегда можете обновить шаблон, загрузив новый файл."
             )
-            bot.reply_to(message, success_text)
         else:
-            bot.reply_to(message, "❌ Пожалуйста, отправьте файл в формате CSV.")
+            result_text = "❌ В файле нет ни одной корректной строки, текущий шаблон цен не изменён."
+        if result['error_count']:
+            result_text += f"\n\n⚠️ Строк с ошибками: {result['error_count']}\n" + "\n".join(
+                f"   • строка {line_number}: {error}" for line_number, error in result['errors'][:10])
+        reply_to(message, result_text)
     except Exception as e:
         logger.error(f"Error in process_price_template: {e}")
-        bot.reply_to(message, "❌ Произошла ошибка при обработке шаблона цен. Пожалуйста, проверьте формат файла и попробуйте снова.")
-
-def update_wb_prices(user_id, price_data):
-    try:
-        cursor.execute("DELETE FROM wb_prices WHERE user_id = ?", (user_id,))
-        for item in price_data:
-            cursor.execute('''INSERT INTO wb_prices (user_id, nmId, price, discount) 
-                              VALUES (?, ?, ?, ?)''', 
-                           (user_id, item['nmId'], item['price'], item['discount']))
-        conn.commit()
-    except sqlite3.Error as e:
-        logger.error(f"Database error in update_wb_prices: {e}")
+        reply_to(message, "❌ Произошла ошибка при обработке шаблона цен. Пожалуйста, проверьте формат файла и попробуйте снова.")
+
+# 🧭 Маршрутизация: точные ключи ищутся в словаре, параметризованные — в префиксном дереве
+class PrefixTrie:
+    def __init__(self):
+        self._root = {}
+
+    def insert(self, prefix, value):
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[''] = value
+
+    def match(self, text):
+        # Значение самого длинного зарегистрированного префикса строки
+        node, found = self._root, None
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            found = node.get('', found)
+        return found
+
+class Router:
+    def __init__(self):
+        self._exact = {}
+        self._prefixes = PrefixTrie()
+
+    # В таблицу маршрутов попадает обёртка с метриками, сама функция остаётся без изменений
+    def exact(self, *keys):
+        def decorator(handler):
+            wrapped = instrumented('bot_handler')(handler)
+            for key in keys:
+                self._exact[key] = wrapped
+            return handler
+        return decorator
+
+    def prefix(self, prefix):
+        def decorator(handler):
+            self._prefixes.insert(prefix, instrumented('bot_handler')(handler))
+            return handler
+        return decorator
+
+    def resolve(self, key):
+        handler = self._exact.get(key)
+        return handler if handler is not None else self._prefixes.match(key)
+
+callback_router = Router()
+message_router = Router()
+
+@bot.callback_query_handler(func=lambda call: True)
+def route_callback(call):
+    handler = callback_router.resolve(call.data or '')
+    if handler is None:
+        # Кнопка из старого сообщения: просто убираем индикатор загрузки
+        bot.answer_callback_query(call.id)
+        return
+    handler(call)
+
+@bot.message_handler(content_types=['text'])
+def route_message(message):
+    text = message.text or ''
+    handler = message_router.resolve(text)
+    if handler is None and text.startswith('/'):
+        # /command@bot_name аргументы
+        handler = message_router.resolve(text.split()[0].split('@')[0])
+    if handler is not None:
+        handler(message)
 
 # 🤖 Обработчики команд и сообщений
-@bot.message_handler(commands=['start'])
+@message_router.exact("/start")
 def send_welcome(message):
     try:
         add_user(message.chat.id)
@@ -468,12 +2123,12 @@ def send_welcome(message):
             "   • 💰 Увеличить вашу прибыль\n\n"
             "👇 Нажмите кнопку ниже, когда будете готовы начать!"
         )
-        bot.reply_to(message, welcome_text, reply_markup=keyboard)
+        reply_to(message, welcome_text, reply_markup=keyboard)
     except Exception as e:
         logger.error(f"Error in send_welcome: {e}")
-        bot.reply_to(message, "❌ Произошла ошибка при запуске бота. Пожалуйста, попробуйте позже.")
+        reply_to(message, "❌ Произошла ошибка при запуске бота. Пожалуйста, попробуйте позже.")
 
-@bot.callback_query_handler(func=lambda call: call.data == "check_subscription")
+@callback_router.exact("check_subscription")
 def handle_subscription_check(call):
     try:
         if check_subscription(call.message.chat.id):
@@ -493,12 +2148,12 @@ def show_main_menu(message):
             InlineKeyboardButton("🛍 Ozon", callback_data="ozon"),
             InlineKeyboardButton("❓ Помощь", callback_data="help")
         )
-        bot.send_message(message.chat.id, "🔍 Выберите действие:", reply_markup=keyboard)
+        send_message(message.chat.id, "🔍 Выберите действие:", reply_markup=keyboard)
     except Exception as e:
         logger.error(f"Error in show_main_menu: {e}")
-        bot.reply_to(message, "❌ Произошла ошибка при отображении меню. Пожалуйста, попробуйте позже.")
+        reply_to(message, "❌ Произошла ошибка при отображении меню. Пожалуйста, попробуйте позже.")
 
-@bot.callback_query_handler(func=lambda call: call.data == "profile")
+@callback_router.exact("profile")
 def profile_callback(call):
     try:
         show_profile(call.message)
@@ -506,7 +2161,7 @@ def profile_callback(call):
         logger.error(f"Error in profile_callback: {e}")
         bot.answer_callback_query(call.id, "❌ Не удалось загрузить профиль. Пожалуйста, попробуйте позже.")
 
-@bot.callback_query_handler(func=lambda call: call.data in ["wb", "ozon"])
+@callback_router.exact("wb", "ozon")
 def handle_marketplace(call):
     try:
         if not check_subscription(call.message.chat.id):
@@ -519,7 +2174,10 @@ def handle_marketplace(call):
             KeyboardButton("⚙️ Настройки"),
             KeyboardButton("🚫 Исключение по товару"),
             KeyboardButton("✅ Включить мониторинг"),
-            KeyboardButton("❌ Отключить мониторинг")
+            KeyboardButton("❌ Отключить мониторинг"),
+            KeyboardButton("📥 Импорт исключений"),
+            KeyboardButton("📤 Экспорт исключений"),
+            KeyboardButton("💹 Прибыльность акций")
         )
         if call.data == "wb":
             keyboard.add(KeyboardButton("📊 Загрузить шаблон цен"))
@@ -527,12 +2185,12 @@ def handle_marketplace(call):
         inline_keyboard = InlineKeyboardMarkup()
         inline_keyboard.add(InlineKeyboardButton("◀️ Назад", callback_data="back_to_main"))
         
-        bot.send_message(
+        send_message(
             call.message.chat.id,
             f"🛍 Вы выбрали {marketplace}.\n\n🔍 Выберите действие или вернитесь назад:",
             reply_markup=keyboard
         )
-        bot.send_message(
+        send_message(
             call.message.chat.id,
             "📌 Для возврата в главное меню нажмите кнопку ниже:",
             reply_markup=inline_keyboard
@@ -541,7 +2199,7 @@ def handle_marketplace(call):
         logger.error(f"Error in handle_marketplace: {e}")
         bot.answer_callback_query(call.id, "❌ Произошла ошибка. Пожалуйста, попробуйте позже.")
 
-@bot.callback_query_handler(func=lambda call: call.data == "back_to_main")
+@callback_router.exact("back_to_main")
 def back_to_main(call):
     try:
         show_main_menu(call.message)
@@ -549,7 +2207,7 @@ def back_to_main(call):
         logger.error(f"Error in back_to_main: {e}")
         bot.answer_callback_query(call.id, "❌ Не удалось вернуться в главное меню. Пожалуйста, попробуйте позже.")
 
-@bot.callback_query_handler(func=lambda call: call.data == "help")
+@callback_router.exact("help")
 def show_help(call):
     try:
         help_text = """
@@ -563,10 +2221,11 @@ def show_help(call):
         /return_wb_[ID] - Вернуть скидку товара на Wildberries
         /auto_cancel_on - Включить автоматическую отмену акций
         /auto_cancel_off - Выключить автоматическую отмену акций
+        /simulate - Прибыльность товаров в текущих акциях
         """
         keyboard = InlineKeyboardMarkup()
         keyboard.add(InlineKeyboardButton("◀️ Назад", callback_data="back_to_main"))
-        bot.edit_message_text(help_text, call.message.chat.id, call.message.message_id, reply_markup=keyboard)
+        edit_message_text(help_text, call.message.chat.id, call.message.message_id, reply_markup=keyboard)
     except Exception as e:
         logger.error(f"Error in show_help: {e}")
         bot.answer_callback_query(call.id, "❌ Не удалось отобразить справку. Пожалуйста, попробуйте позже.")
@@ -574,16 +2233,17 @@ def show_help(call):
 def show_profile(message):
     try:
         user_id = message.chat.id
-        cursor.execute("SELECT subscription_end, balance, auto_cancel_enabled FROM users WHERE chat_id = ?", (user_id,))
-        result = cursor.fetchone()
-        if result:
-            subscription_end, balance, auto_cancel_enabled = result
+        user = get_user(user_id)
+        if user:
+            subscription_end, auto_cancel_enabled = user['subscription_end'], user['auto_cancel_enabled']
             referral_count = get_referral_count(user_id)
+            actions_count = sum(count for _, count in get_user_analytics(user_id))
             profile_text = (
                 "👤 Ваш профиль:\n\n"
                 f"📅 Дата истечения подписки: {subscription_end}\n"
                 f"👥 Вы пригласили: {referral_count} пользователей\n"
-                f"🔄 Автоотмена акций: {'✅ Включена' if auto_cancel_enabled else '❌ Выключена'}\n\n"
+                f"🔄 Автоотмена акций: {'✅ Включена' if auto_cancel_enabled else '❌ Выключена'}\n"
+                f"📈 Действий с товарами за {ANALYTICS_WINDOW_DAYS} дн.: {actions_count}\n\n"
                 "🎁 За каждого приглашенного пользователя вы получаете:\n"
                 "   скидку 10% на подписку\n\n"
                 "🔗 Ваша реферальная ссылка:\n"
@@ -596,14 +2256,14 @@ def show_profile(message):
                 InlineKeyboardButton("◀️ Вернуться в меню", callback_data="back_to_main"),
                 InlineKeyboardButton("🔗 Поделиться ссылкой", callback_data="share_referral")
             )
-            bot.send_message(message.chat.id, profile_text, reply_markup=keyboard)
+            send_message(message.chat.id, profile_text, reply_markup=keyboard)
         else:
-            bot.send_message(message.chat.id, "❌ Произошла ошибка при получении данных профиля")
+            send_message(message.chat.id, "❌ Произошла ошибка при получении данных профиля")
     except Exception as e:
         logger.error(f"Error in show_profile: {e}")
-        bot.send_message(message.chat.id, "❌ Не удалось загрузить профиль. Пожалуйста, попробуйте позже.")
+        send_message(message.chat.id, "❌ Не удалось загрузить профиль. Пожалуйста, попробуйте позже.")
 
-@bot.callback_query_handler(func=lambda call: call.data == "support")
+@callback_router.exact("support")
 def show_support(call):
     try:
         support_text = (
@@ -613,12 +2273,12 @@ def show_support(call):
         keyboard = InlineKeyboardMarkup()
         keyboard.add(InlineKeyboardButton("📝 Написать в поддержку", url="https://t.me/shelbitofficial"))
         keyboard.add(InlineKeyboardButton("◀️ Назад", callback_data="back_to_profile"))
-        bot.edit_message_text(support_text, call.message.chat.id, call.message.message_id, reply_markup=keyboard, parse_mode="HTML")
+        edit_message_text(support_text, call.message.chat.id, call.message.message_id, reply_markup=keyboard, parse_mode="HTML")
     except Exception as e:
         logger.error(f"Error in show_support: {e}")
         bot.answer_callback_query(call.id, "❌ Не удалось отобразить информацию о поддержке. Пожалуйста, попробуйте позже.")
 
-@bot.callback_query_handler(func=lambda call: call.data == "back_to_profile")
+@callback_router.exact("back_to_profile")
 def back_to_profile(call):
     try:
         show_profile(call.message)
@@ -626,7 +2286,7 @@ def back_to_profile(call):
         logger.error(f"Error in back_to_profile: {e}")
         bot.answer_callback_query(call.id, "❌ Не удалось вернуться к профилю. Пожалуйста, попробуйте позже.")
 
-@bot.callback_query_handler(func=lambda call: call.data == "tariffs")
+@callback_router.exact("tariffs")
 def show_tariffs(call):
     try:
         tariffs_text = (
@@ -651,12 +2311,12 @@ def show_tariffs(call):
             InlineKeyboardButton("🎟 Промокод", callback_data="enter_promo"),
             InlineKeyboardButton("◀️ Назад", callback_data="back_to_profile")
         )
-        bot.edit_message_text(tariffs_text, call.message.chat.id, call.message.message_id, reply_markup=keyboard, parse_mode="HTML")
+        edit_message_text(tariffs_text, call.message.chat.id, call.message.message_id, reply_markup=keyboard, parse_mode="HTML")
     except Exception as e:
         logger.error(f"Error in show_tariffs: {e}")
         bot.answer_callback_query(call.id, "❌ Не удалось отобразить тарифы. Пожалуйста, попробуйте позже.")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("subscribe_"))
+@callback_router.prefix("subscribe_")
 def handle_subscription(call):
     try:
         duration = "1 month" if call.data == "subscribe_1month" else "1 year"
@@ -677,6 +2337,7 @@ def handle_subscription(call):
         bot.answer_callback_query(call.id, "❌ Произошла ошибка при оформлении подписки. Пожалуйста, попробуйте позже.")
 
 @bot.pre_checkout_query_handler(func=lambda query: True)
+@instrumented('bot_handler')
 def process_pre_checkout_query(pre_checkout_query):
     try:
         bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
@@ -685,27 +2346,29 @@ def process_pre_checkout_query(pre_checkout_query):
         bot.answer_pre_checkout_query(pre_checkout_query.id, ok=False, error_message="❌ Произошла ошибка при обработке платежа.")
 
 @bot.message_handler(content_types=['successful_payment'])
+@instrumented('bot_handler')
 def process_successful_payment(message):
     try:
         duration = "1 month" if message.successful_payment.invoice_payload == "sub_1 month" else "1 year"
-        cursor.execute(f"UPDATE users SET subscription_end = date('now', '+{duration}') WHERE chat_id = ?", (message.chat.id,))
-        conn.commit()
-        bot.send_message(message.chat.id, f"✅ Спасибо за оплату! Ваша подписка на {duration} активирована.")
+        db.execute(f"UPDATE users SET subscription_end = date('now', '+{duration}') WHERE chat_id = ?", (message.chat.id,))
+        user_cache.invalidate(message.chat.id)
+        send_message(message.chat.id, f"✅ Спасибо за оплату! Ваша подписка на {duration} активирована.")
         show_main_menu(message)
     except Exception as e:
         logger.error(f"Error in process_successful_payment: {e}")
-        bot.send_message(message.chat.id, "❌ Произошла ошибка при активации подписки. Пожалуйста, обратитесь в поддержку.")
+        send_message(message.chat.id, "❌ Произошла ошибка при активации подписки. Пожалуйста, обратитесь в поддержку.")
 
-@bot.callback_query_handler(func=lambda call: call.data == "enter_promo")
+@callback_router.exact("enter_promo")
 def ask_for_promo_code(call):
     try:
         bot.answer_callback_query(call.id)
-        msg = bot.send_message(call.message.chat.id, "🎟 Введите промокод:")
+        msg = send_message(call.message.chat.id, "🎟 Введите промокод:")
         bot.register_next_step_handler(msg, process_promo_code)
     except Exception as e:
         logger.error(f"Error in ask_for_promo_code: {e}")
-        bot.send_message(call.message.chat.id, "❌ Произошла ошибка. Пожалуйста, попробуйте позже.")
+        send_message(call.message.chat.id, "❌ Произошла ошибка. Пожалуйста, попробуйте позже.")
 
+@instrumented('bot_handler')
 def process_promo_code(message):
     try:
         promo_code = message.text.strip().upper()
@@ -717,15 +2380,15 @@ def process_promo_code(message):
                 f"💰 Скидка: {discount}%\n\n"
                 "Спасибо за использование нашего бота!"
             )
-            bot.reply_to(message, success_text)
+            reply_to(message, success_text)
         else:
-            bot.reply_to(message, "❌ Неверный промокод или он уже был использован.")
+            reply_to(message, "❌ Неверный промокод или он уже был использован.")
         show_profile(message)
     except Exception as e:
         logger.error(f"Error in process_promo_code: {e}")
-        bot.reply_to(message, "❌ Произошла ошибка при обработке промокода. Пожалуйста, попробуйте позже.")
+        reply_to(message, "❌ Произошла ошибка при обработке промокода. Пожалуйста, попробуйте позже.")
 
-@bot.callback_query_handler(func=lambda call: call.data == "share_referral")
+@callback_router.exact("share_referral")
 def share_referral(call):
     try:
         user_id = call.message.chat.id
@@ -740,43 +2403,48 @@ def share_referral(call):
         )
         keyboard = InlineKeyboardMarkup()
         keyboard.add(InlineKeyboardButton("📤 Поделиться в Telegram", switch_inline_query=f"Попробуй бот для управления акциями! {referral_link}"))
-        bot.send_message(call.message.chat.id, share_text, reply_markup=keyboard)
+        send_message(call.message.chat.id, share_text, reply_markup=keyboard)
     except Exception as e:
         logger.error(f"Error in share_referral: {e}")
         bot.answer_callback_query(call.id, "❌ Не удалось сгенерировать реферальную ссылку. Пожалуйста, попробуйте позже.")
 
-@bot.message_handler(func=lambda message: message.text in ["⚙️ Настройки", "🚫 Исключение по товару", "✅ Включить мониторинг", "❌ Отключить мониторинг", "📊 Загрузить шаблон цен"])
+@message_router.exact("⚙️ Настройки", "🚫 Исключение по товару", "✅ Включить мониторинг", "❌ Отключить мониторинг", "📊 Загрузить шаблон цен",
+                      "📥 Импорт исключений", "📤 Экспорт исключений")
 def handle_marketplace_actions(message):
     try:
         if not check_subscription(message.chat.id):
-            bot.reply_to(message, "⚠️ Для доступа к этому разделу необходима активная подписка.")
+            reply_to(message, "⚠️ Для доступа к этому разделу необходима активная подписка.")
             return
 
         if message.text == "⚙️ Настройки":
             show_settings(message)
         elif message.text == "🚫 Исключение по товару":
-            bot.reply_to(message, "🔢 Введите ID товара для добавления в исключения:")
+            reply_to(message, "🔢 Введите ID товара для добавления в исключения:")
             bot.register_next_step_handler(message, process_add_exception)
         elif message.text == "✅ Включить мониторинг":
             enable_monitoring(message)
         elif message.text == "❌ Отключить мониторинг":
             disable_monitoring(message)
         elif message.text == "📊 Загрузить шаблон цен":
-            bot.reply_to(message, "📁 Пожалуйста, отправьте файл с шаблоном цен в формате CSV.")
+            reply_to(message, "📁 Пожалуйста, отправьте файл с шаблоном цен в формате CSV.")
             bot.register_next_step_handler(message, process_price_template)
+        elif message.text == "📥 Импорт исключений":
+            reply_to(message, "📁 Отправьте CSV-файл с колонками product_id и (необязательно) marketplace: ozon, wb или both.")
+            bot.register_next_step_handler(message, process_exceptions_import)
+        elif message.text == "📤 Экспорт исключений":
+            export_exceptions(message)
     except Exception as e:
         logger.error(f"Error in handle_marketplace_actions: {e}")
-        bot.reply_to(message, "❌ Произошла ошибка. Пожалуйста, попробуйте позже.")
+        reply_to(message, "❌ Произошла ошибка. Пожалуйста, попробуйте позже.")
 
 def show_settings(message):
     try:
         user_id = message.chat.id
-        cursor.execute("SELECT wb_api_key, ozon_api_key FROM users WHERE chat_id = ?", (user_id,))
-        result = cursor.fetchone()
+        user = get_user(user_id)
         
         keyboard = InlineKeyboardMarkup()
-        if result:
-            wb_api_key, ozon_api_key = result
+        if user:
+            wb_api_key, ozon_api_key = user['wb_api_key'], user['ozon_api_key']
             if wb_api_key:
                 keyboard.row(InlineKeyboardButton("🔄 Обновить интеграцию с Wildberries", callback_data="integrate_wb"))
             else:
@@ -794,12 +2462,12 @@ def show_settings(message):
             "Здесь вы можете настроить интеграцию с маркетплейсами и другие параметры бота.\n\n"
             "🔍 Выберите действие из меню ниже:"
         )
-        bot.send_message(message.chat.id, settings_text, reply_markup=keyboard, parse_mode="HTML")
+        send_message(message.chat.id, settings_text, reply_markup=keyboard, parse_mode="HTML")
     except Exception as e:
         logger.error(f"Error in show_settings: {e}")
-        bot.reply_to(message, "❌ Не удалось отобразить настройки. Пожалуйста, попробуйте позже.")
+        reply_to(message, "❌ Не удалось отобразить настройки. Пожалуйста, попробуйте позже.")
 
-@bot.callback_query_handler(func=lambda call: call.data in ["integrate_ozon", "integrate_wb"])
+@callback_router.exact("integrate_ozon", "integrate_wb")
 def handle_integration(call):
     try:
         marketplace = "Ozon" if call.data == "integrate_ozon" else "Wildberries"
@@ -815,17 +2483,18 @@ def handle_integration(call):
             "4. Скопируйте ваш API ключ\n\n"
             "⚠️ Никогда не передавайте свой API ключ третьим лицам!"
         )
-        msg = bot.send_message(call.message.chat.id, integration_text, parse_mode="HTML")
+        msg = send_message(call.message.chat.id, integration_text, parse_mode="HTML")
         bot.register_next_step_handler(msg, process_api_key, marketplace)
     except Exception as e:
         logger.error(f"Error in handle_integration: {e}")
         bot.answer_callback_query(call.id, "❌ Произошла ошибка. Пожалуйста, попробуйте позже.")
 
+@instrumented('bot_handler')
 def process_api_key(message, marketplace):
     try:
         api_key = message.text.strip()
         if marketplace == "Ozon":
-            msg = bot.reply_to(message, "🆔 Теперь введите ваш Client ID для Ozon:")
+            msg = reply_to(message, "🆔 Теперь введите ваш Client ID для Ozon:")
             bot.register_next_step_handler(msg, process_client_id, api_key)
         else:
             update_marketplace_credentials(message.chat.id, 'wb', api_key)
@@ -834,12 +2503,13 @@ def process_api_key(message, marketplace):
                 "Теперь вы можете использовать все функции бота для работы с акциями на Wildberries.\n"
                 "🔍 Если у вас возникнут вопросы, не стесняйтесь обращаться в службу поддержки."
             )
-            bot.reply_to(message, success_text)
+            reply_to(message, success_text)
             show_settings(message)
     except Exception as e:
         logger.error(f"Error in process_api_key: {e}")
-        bot.reply_to(message, "❌ Произошла ошибка при обработке API ключа. Пожалуйста, попробуйте позже.")
+        reply_to(message, "❌ Произошла ошибка при обработке API ключа. Пожалуйста, попробуйте позже.")
 
+@instrumented('bot_handler')
 def process_client_id(message, api_key):
     try:
         client_id = message.text.strip()
@@ -849,13 +2519,13 @@ def process_client_id(message, api_key):
             "Теперь вы можете использовать все функции бота для работы с акциями на Ozon.\n"
             "🔍 Если у вас возникнут вопросы, не стесняйтесь обращаться в службу поддержки."
         )
-        bot.reply_to(message, success_text)
+        reply_to(message, success_text)
         show_settings(message)
     except Exception as e:
         logger.error(f"Error in process_client_id: {e}")
-        bot.reply_to(message, "❌ Произошла ошибка при обработке Client ID. Пожалуйста, попробуйте позже.")
+        reply_to(message, "❌ Произошла ошибка при обработке Client ID. Пожалуйста, попробуйте позже.")
 
-@bot.callback_query_handler(func=lambda call: call.data == "auto_cancel_settings")
+@callback_router.exact("auto_cancel_settings")
 def auto_cancel_settings(call):
     try:
         user_id = call.message.chat.id
@@ -875,12 +2545,12 @@ def auto_cancel_settings(call):
                                           callback_data="toggle_auto_cancel"))
         keyboard.row(InlineKeyboardButton("◀️ Назад", callback_data="back_to_settings"))
         
-        bot.edit_message_text(settings_text, call.message.chat.id, call.message.message_id, reply_markup=keyboard, parse_mode="HTML")
+        edit_message_text(settings_text, call.message.chat.id, call.message.message_id, reply_markup=keyboard, parse_mode="HTML")
     except Exception as e:
         logger.error(f"Error in auto_cancel_settings: {e}")
         bot.answer_callback_query(call.id, "❌ Произошла ошибка. Пожалуйста, попробуйте позже.")
 
-@bot.callback_query_handler(func=lambda call: call.data == "toggle_auto_cancel")
+@callback_router.exact("toggle_auto_cancel")
 def toggle_auto_cancel(call):
     try:
         user_id = call.message.chat.id
@@ -897,7 +2567,7 @@ def toggle_auto_cancel(call):
         logger.error(f"Error in toggle_auto_cancel: {e}")
         bot.answer_callback_query(call.id, "❌ Произошла ошибка. Пожалуйста, попробуйте позже.")
 
-@bot.callback_query_handler(func=lambda call: call.data == "back_to_settings")
+@callback_router.exact("back_to_settings")
 def back_to_settings(call):
     try:
         show_settings(call.message)
@@ -905,7 +2575,7 @@ def back_to_settings(call):
         logger.error(f"Error in back_to_settings: {e}")
         bot.answer_callback_query(call.id, "❌ Не удалось вернуться к настройкам. Пожалуйста, попробуйте позже.")
 
-@bot.callback_query_handler(func=lambda call: call.data == "back_to_marketplace")
+@callback_router.exact("back_to_marketplace")
 def back_to_marketplace(call):
     try:
         keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
@@ -920,12 +2590,12 @@ def back_to_marketplace(call):
         inline_keyboard = InlineKeyboardMarkup()
         inline_keyboard.add(InlineKeyboardButton("◀️ Назад в главное меню", callback_data="back_to_main"))
         
-        bot.send_message(
+        send_message(
             call.message.chat.id,
             "🔍 Выберите действие или вернитесь в главное меню:",
             reply_markup=keyboard
         )
-        bot.send_message(
+        send_message(
             call.message.chat.id,
             "📌 Для возврата в главное меню нажмите кнопку ниже:",
             reply_markup=inline_keyboard
@@ -937,6 +2607,7 @@ def back_to_marketplace(call):
         logger.error(f"Error in back_to_marketplace: {e}")
         bot.answer_callback_query(call.id, "❌ Не удалось вернуться к настройкам маркетплейса. Пожалуйста, попробуйте позже.")
 
+@instrumented('bot_handler')
 def process_add_exception(message):
     try:
         product_id = message.text.strip()
@@ -946,46 +2617,133 @@ def process_add_exception(message):
             "Теперь этот товар не будет учитываться при автоматическом мониторинге акций.\n"
             "🔍 Вы всегда можете изменить список исключений в настройках бота."
         )
-        bot.reply_to(message, success_text)
+        reply_to(message, success_text)
     except Exception as e:
         logger.error(f"Error in process_add_exception: {e}")
-        bot.reply_to(message, "❌ Произошла ошибка при добавлении исключения. Пожалуйста, попробуйте позже.")
+        reply_to(message, "❌ Произошла ошибка при добавлении исключения. Пожалуйста, попробуйте позже.")
+
+@instrumented('bot_handler')
+def process_exceptions_import(message):
+    try:
+        if not message.document:
+            reply_to(message, "❌ Пожалуйста, отправьте файл в формате CSV.")
+            return
+        file_info = bot.get_file(message.document.file_id)
+        rows, errors = parse_ignored_products_csv(bot.download_file(file_info.file_path).decode('utf-8-sig'))
+        added = import_ignored_products(message.chat.id, rows)
+        result_text = (
+            "✅ Импорт исключений завершён.\n\n"
+            f"📦 Строк с товарами: {len(rows)}\n"
+            f"➕ Добавлено новых: {added}\n"
+            f"🔁 Уже были в исключениях: {len(rows) - added}"
+        )
+        if errors:
+            result_text += f"\n❌ Строк с ошибками: {len(errors)}\n" + "\n".join(
+                f"   • строка {line_number}: {error}" for line_number, error in errors[:10])
+        reply_to(message, result_text)
+    except Exception as e:
+        logger.error(f"Error in process_exceptions_import: {e}")
+        reply_to(message, "❌ Произошла ошибка при импорте исключений. Пожалуйста, проверьте формат файла и попробуйте снова.")
+
+def export_exceptions(message):
+    try:
+        document = io.BytesIO(export_ignored_products_csv(message.chat.id).encode('utf-8'))
+        document.name = "exclusions.csv"
+        send_document(message.chat.id, document, caption="📤 Ваш список исключений")
+    except Exception as e:
+        logger.error(f"Error in export_exceptions: {e}")
+        reply_to(message, "❌ Не удалось выгрузить исключения. Пожалуйста, попробуйте позже.")
+
+@message_router.exact("/simulate", "💹 Прибыльность акций")
+def show_promo_simulation(message):
+    try:
+        if not check_subscription(message.chat.id):
+            reply_to(message, "⚠️ Для доступа к этому разделу необходима активная подписка.")
+            return
+
+        report = simulate_promotions(message.chat.id)
+        if report is None:
+            reply_to(message, "❌ Не удалось рассчитать прибыльность акций. Пожалуйста, попробуйте позже.")
+            return
+        if not report['promotions']:
+            reply_to(message, "ℹ️ Пока нечего считать: загрузите шаблон цен (📊 Загрузить шаблон цен) и дождитесь "
+                              "ближайшей проверки акций.")
+            return
+
+        lines = ["💹 <b>Прибыльность акций</b>\n",
+                 "Цена каждого товара в акции сравнивается с минимальной ценой из шаблона.\n"]
+        for marketplace, action_id, total, losing, loss in report['promotions'][:SIMULATION_TOP_SIZE]:
+            icon = "🛍" if marketplace == 'ozon' else "🛒"
+            title = html.escape(str(get_promotion_title(message.chat.id, marketplace, action_id)))
+            lines.append(f"{icon} «{title}»: товаров {total}, в убыток {losing}, потери {abs(loss):.2f} ₽")
+        if len(report['promotions']) > SIMULATION_TOP_SIZE:
+            lines.append(f"… и ещё акций: {len(report['promotions']) - SIMULATION_TOP_SIZE}")
+
+        if report['losers']:
+            lines.append("\n📉 <b>Самые убыточные товары:</b>")
+            for marketplace, action_id, product_id, name, _, promo, floor, margin in report['losers']:
+                title = html.escape(str(get_promotion_title(message.chat.id, marketplace, action_id)))
+                percent = f", {margin / floor * 100:.1f}%" if floor else ""
+                lines.append(f"🆔 {product_id} • {html.escape(name or 'Нет названия')} — «{title}»: "
+                             f"{promo:.2f} при минимуме {floor:.2f} ({margin:.2f}{percent})")
+        else:
+            lines.append("\n✅ Ни один товар не продаётся в акциях ниже минимальной цены.")
+        if report['uncovered']:
+            lines.append(f"\nℹ️ Товаров в акциях без цены в шаблоне: {report['uncovered']}")
+
+        keyboard = InlineKeyboardMarkup()
+        keyboard.add(InlineKeyboardButton("📄 Выгрузить в CSV", callback_data="simulation_csv"))
+        reply_to(message, "\n".join(lines), reply_markup=keyboard, parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Error in show_promo_simulation: {e}")
+        reply_to(message, "❌ Не удалось рассчитать прибыльность акций. Пожалуйста, попробуйте позже.")
+
+@callback_router.exact("simulation_csv")
+def export_promo_simulation(call):
+    try:
+        document = io.BytesIO(export_promo_simulation_csv(call.message.chat.id).encode('utf-8'))
+        document.name = "promo_profitability.csv"
+        send_document(call.message.chat.id, document, caption="📄 Прибыльность товаров в акциях, самые убыточные первыми")
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        logger.error(f"Error in export_promo_simulation: {e}")
+        bot.answer_callback_query(call.id, "❌ Не удалось выгрузить отчёт. Пожалуйста, попробуйте позже.")
 
 def enable_monitoring(message):
     try:
         user_id = message.chat.id
-        cursor.execute("UPDATE users SET monitoring_enabled = 1 WHERE chat_id = ?", (user_id,))
-        conn.commit()
+        db.execute("UPDATE users SET monitoring_enabled = 1 WHERE chat_id = ?", (user_id,))
+        user_cache.invalidate(user_id)
         success_text = (
             "✅ Мониторинг товаров успешно включен!\n\n"
             "Теперь бот будет автоматически отслеживать акции на ваши товары и уведомлять вас о них.\n"
             "🔍 Вы всегда можете изменить настройки мониторинга в разделе настроек."
         )
-        bot.reply_to(message, success_text)
+        reply_to(message, success_text)
     except Exception as e:
         logger.error(f"Error in enable_monitoring: {e}")
-        bot.reply_to(message, "❌ Не удалось включить мониторинг. Пожалуйста, попробуйте позже.")
+        reply_to(message, "❌ Не удалось включить мониторинг. Пожалуйста, попробуйте позже.")
 
 def disable_monitoring(message):
     try:
         user_id = message.chat.id
-        cursor.execute("UPDATE users SET monitoring_enabled = 0 WHERE chat_id = ?", (user_id,))
-        conn.commit()
+        db.execute("UPDATE users SET monitoring_enabled = 0 WHERE chat_id = ?", (user_id,))
+        user_cache.invalidate(user_id)
         warning_text = (
             "❌ Мониторинг товаров отключен.\n\n"
             "⚠️ Внимание: теперь вы не будете получать уведомления о новых акциях на ваши товары.\n"
             "🔍 Рекомендуем включить мониторинг, чтобы всегда быть в курсе изменений."
         )
-        bot.reply_to(message, warning_text)
+        reply_to(message, warning_text)
     except Exception as e:
         logger.error(f"Error in disable_monitoring: {e}")
-        bot.reply_to(message, "❌ Не удалось отключить мониторинг. Пожалуйста, попробуйте позже.")
+        reply_to(message, "❌ Не удалось отключить мониторинг. Пожалуйста, попробуйте позже.")
 
-@bot.message_handler(func=lambda message: message.text.startswith('/remove_ozon_'))
+@message_router.prefix("/remove_ozon_")
 def remove_ozon_product(message):
     try:
         if not check_subscription(message.chat.id):
-            bot.reply_to(message, "❗ Ваша подписка истекла. Пожалуйста, обновите подписку.")
+            reply_to(message, "❗ Ваша подписка истекла. Пожалуйста, обновите подписку.")
             return
 
         product_id = message.text.split('_')[-1]
@@ -998,21 +2756,21 @@ def remove_ozon_product(message):
                     "ℹ️ Изменения могут отражаться на платформе с небольшой задержкой.\n"
                     "🔍 Рекомендуем проверить статус товара через некоторое время."
                 )
-                bot.reply_to(message, success_text)
+                reply_to(message, success_text)
                 log_action(message.chat.id, 'ozon', 'remove_from_promo', product_id)
             else:
-                bot.reply_to(message, f"❌ Не удалось удалить товар с ID {product_id} из акции Ozon.")
+                reply_to(message, f"❌ Не удалось удалить товар с ID {product_id} из акции Ozon.")
         else:
-            bot.reply_to(message, "❗ Не удалось получить данные для доступа к API Ozon. Пожалуйста, проверьте настройки интеграции.")
+            reply_to(message, "❗ Не удалось получить данные для доступа к API Ozon. Пожалуйста, проверьте настройки интеграции.")
     except Exception as e:
         logger.error(f"Error in remove_ozon_product: {e}")
-        bot.reply_to(message, "❌ Произошла ошибка при удалении товара из акции. Пожалуйста, попробуйте позже.")
+        reply_to(message, "❌ Произошла ошибка при удалении товара из акции. Пожалуйста, попробуйте позже.")
 
-@bot.message_handler(func=lambda message: message.text.startswith('/return_wb_'))
+@message_router.prefix("/return_wb_")
 def return_wb_discount(message):
     try:
         if not check_subscription(message.chat.id):
-            bot.reply_to(message, "❗ Ваша подписка истекла. Пожалуйста, обновите подписку.")
+            reply_to(message, "❗ Ваша подписка истекла. Пожалуйста, обновите подписку.")
             return
 
         product_id = message.text.split('_')[-1]
@@ -1029,17 +2787,17 @@ def return_wb_discount(message):
                     "ℹ️ Изменения могут отражаться на платформе с небольшой задержкой.\n"
                     "🔍 Рекомендуем проверить статус товара через некоторое время."
                 )
-                bot.reply_to(message, success_text)
+                reply_to(message, success_text)
                 log_action(message.chat.id, 'wb', 'return_discount', product_id)
             else:
-                bot.reply_to(message, f"❌ Не удалось вернуть скидку для товара с ID {product_id} на Wildberries.")
+                reply_to(message, f"❌ Не удалось вернуть скидку для товара с ID {product_id} на Wildberries.")
         else:
-            bot.reply_to(message, "❗ Не удалось получить данные для доступа к API Wildberries. Пожалуйста, проверьте настройки интеграции.")
+            reply_to(message, "❗ Не удалось получить данные для доступа к API Wildberries. Пожалуйста, проверьте настройки интеграции.")
     except Exception as e:
         logger.error(f"Error in return_wb_discount: {e}")
-        bot.reply_to(message, "❌ Произошла ошибка при возврате скидки. Пожалуйста, попробуйте позже.")
+        reply_to(message, "❌ Произошла ошибка при возврате скидки. Пожалуйста, попробуйте позже.")
 
-@bot.message_handler(commands=['feedback'])
+@message_router.exact("/feedback")
 def send_feedback(message):
     try:
         feedback_text = (
@@ -1048,181 +2806,1007 @@ def send_feedback(message):
             "Пожалуйста, напишите ваш отзыв или предложение в следующем сообщении.\n\n"
             "🌟 Ваш отзыв поможет нам сделать бот еще лучше!"
         )
-        msg = bot.reply_to(message, feedback_text, parse_mode="HTML")
+        msg = reply_to(message, feedback_text, parse_mode="HTML")
         bot.register_next_step_handler(msg, process_feedback)
     except Exception as e:
         logger.error(f"Error in send_feedback: {e}")
-        bot.reply_to(message, "❌ Произошла ошибка. Пожалуйста, попробуйте отправить отзыв позже.")
+        reply_to(message, "❌ Произошла ошибка. Пожалуйста, попробуйте отправить отзыв позже.")
 
+@instrumented('bot_handler')
 def process_feedback(message):
     try:
         feedback = message.text
         # Здесь можно сохранить отзыв в базу данных или отправить администратору
-        cursor.execute("INSERT INTO feedback (user_id, feedback, date) VALUES (?, ?, datetime('now'))", 
-                       (message.chat.id, feedback))
-        conn.commit()
+        db.execute("INSERT INTO feedback (user_id, feedback, date) VALUES (?, ?, datetime('now'))", 
+                   (message.chat.id, feedback))
         thank_you_text = (
             "🙏 Спасибо за ваш отзыв!\n\n"
             "Мы внимательно изучим ваше сообщение и учтем его в нашей работе.\n"
             "Ваше мнение очень важно для нас и помогает улучшать качество сервиса.\n\n"
             "💬 Если у вас возникнут дополнительные вопросы или предложения, не стесняйтесь обращаться к нам снова!"
         )
-        bot.reply_to(message, thank_you_text)
+        reply_to(message, thank_you_text)
     except Exception as e:
         logger.error(f"Error in process_feedback: {e}")
-        bot.reply_to(message, "❌ Произошла ошибка при обработке отзыва. Пожалуйста, попробуйте позже.")
+        reply_to(message, "❌ Произошла ошибка при обработке отзыва. Пожалуйста, попробуйте позже.")
+
+# 📰 Сводные уведомления по акциям
+def shorten(text, limit):
+    # Обрезаем до экранирования: лимит Telegram считается по тексту после разбора HTML
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def format_digest_row(marketplace, row):
+    product_id, name, price, discount_price, discount = row
+    name = html.escape(shorten(name or 'Нет названия', DIGEST_NAME_LENGTH))
+    if marketplace == 'ozon':
+        return f"🆔 {product_id} • {name} — {price if price is not None else '—'} → {discount_price if discount_price is not None else '—'}"
+    return f"🆔 {product_id} • {name} — {price if price is not None else '—'}, скидка {discount if discount is not None else '—'}%"
+
+def render_promo_digest(chat_id, marketplace, action_id, page, changed_count=None):
+    total = count_promo_snapshot(chat_id, marketplace, action_id)
+    pages = max(1, -(-total // DIGEST_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    rows = get_promo_snapshot_page(chat_id, marketplace, action_id, page * DIGEST_PAGE_SIZE, DIGEST_PAGE_SIZE)
+    title = html.escape(shorten(str(get_promotion_title(chat_id, marketplace, action_id)), DIGEST_TITLE_LENGTH))
+
+    header = "🛍 <b>Акция Ozon" if marketplace == 'ozon' else "🛒 <b>Акция Wildberries"
+    lines = [f"{header} \"{title}\"</b>\n"]
+    if changed_count:
+        lines.append(f"🆕 Новых или изменившихся товаров: {changed_count}")
+    lines.append(f"📦 Всего товаров в акции: {total}")
+    lines.append(f"📄 Страница {page + 1} из {pages}\n")
+    lines.extend(format_digest_row(marketplace, row) for row in rows)
+
+    keyboard = InlineKeyboardMarkup(row_width=3)
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️", callback_data=f"digest_page_{marketplace}_{action_id}_{page - 1}"))
+    navigation.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="digest_noop"))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("▶️", callback_data=f"digest_page_{marketplace}_{action_id}_{page + 1}"))
+    keyboard.row(*navigation)
+    if marketplace == 'ozon':
+        keyboard.row(InlineKeyboardButton("🚫 Удалить все из акции", callback_data=f"digest_remove_{marketplace}_{action_id}"))
+    else:
+        keyboard.row(InlineKeyboardButton("🔄 Вернуть скидку всем", callback_data=f"digest_remove_{marketplace}_{action_id}"))
+    keyboard.row(InlineKeyboardButton("🙈 Игнорировать все", callback_data=f"digest_ignore_{marketplace}_{action_id}"))
+    return "\n".join(lines), keyboard
+
+def send_promo_digest(chat_id, marketplace, action_id, changed_count):
+    text, keyboard = render_promo_digest(chat_id, marketplace, action_id, 0, changed_count)
+    notify(chat_id, text, reply_markup=keyboard, parse_mode="HTML")
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def remove_products_from_promo(chat_id, marketplace, action_id, product_ids, credentials=None):
+    # Возвращает список товаров, для которых маркетплейс подтвердил отмену акции
+    if credentials is None:
+        credentials = get_marketplace_credentials(chat_id, marketplace)
+    if not credentials or not credentials.get('api_key'):
+        return None
+    removed = []
+    if marketplace == 'ozon':
+        for chunk in chunked(product_ids, OZON_BULK_CHUNK_SIZE):
+            removed.extend(remove_ozon_products_from_promo(credentials['api_key'], credentials['client_id'], action_id, chunk))
+    else:
+        for chunk in chunked(product_ids, WB_BULK_CHUNK_SIZE):
+            product_data = [{"nmId": int(product_id), "discount": 0} for product_id in chunk]
+            if update_wb_product_discount(credentials['api_key'], product_data):
+                removed.extend(chunk)
+    return removed
+
+@callback_router.exact("digest_noop")
+def digest_noop(call):
+    bot.answer_callback_query(call.id)
+
+@callback_router.prefix("digest_page_")
+def digest_page(call):
+    try:
+        _, _, marketplace, action_id, page = call.data.split('_')
+        text, keyboard = render_promo_digest(call.message.chat.id, marketplace, action_id, int(page))
+        edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=keyboard, parse_mode="HTML")
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        logger.error(f"Error in digest_page: {e}")
+        bot.answer_callback_query(call.id, "❌ Не удалось открыть страницу. Пожалуйста, попробуйте позже.")
+
+@callback_router.prefix("digest_remove_")
+def digest_remove_all(call):
+    try:
+        chat_id = call.message.chat.id
+        if not check_subscription(chat_id):
+            bot.answer_callback_query(call.id, "❗ Ваша подписка истекла. Пожалуйста, обновите подписку.")
+            return
+
+        _, _, marketplace, action_id = call.data.split('_')
+        bot.answer_callback_query(call.id, "⏳ Обрабатываем товары акции...")
+        product_ids = get_promo_snapshot_product_ids(chat_id, marketplace, action_id)
+        removed = remove_products_from_promo(chat_id, marketplace, action_id, product_ids)
+        if removed is None:
+            send_message(chat_id, "❗ Не удалось получить данные для доступа к API. Пожалуйста, проверьте настройки интеграции.")
+            return
+
+        action_type = 'remove_from_promo' if marketplace == 'ozon' else 'return_discount'
+        log_actions(chat_id, marketplace, action_type, removed)
+        delete_promo_snapshot_products(chat_id, marketplace, action_id, removed)
+        failed = len(product_ids) - len(removed)
+        result_text = (
+            f"✅ Обработано товаров: {len(removed)} из {len(product_ids)}.\n"
+            + (f"❌ Не удалось обработать: {failed}.\n" if failed else "")
+            + "\nℹ️ Изменения могут отражаться на платформе с небольшой задержкой."
+        )
+        send_message(chat_id, result_text)
+    except Exception as e:
+        logger.error(f"Error in digest_remove_all: {e}")
+        send_message(call.message.chat.id, "❌ Произошла ошибка при обработке товаров акции. Пожалуйста, попробуйте позже.")
+
+@callback_router.prefix("digest_ignore_")
+def digest_ignore_all(call):
+    try:
+        chat_id = call.message.chat.id
+        _, _, marketplace, action_id = call.data.split('_')
+        product_ids = get_promo_snapshot_product_ids(chat_id, marketplace, action_id)
+        add_ignored_products(chat_id, marketplace, product_ids)
+        bot.answer_callback_query(call.id, f"🙈 Добавлено в исключения: {len(product_ids)}")
+        text, keyboard = render_promo_digest(chat_id, marketplace, action_id, 0)
+        edit_message_text(text, chat_id, call.message.message_id, reply_markup=keyboard, parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Error in digest_ignore_all: {e}")
+        bot.answer_callback_query(call.id, "❌ Произошла ошибка. Пожалуйста, попробуйте позже.")
+
+# 🛒 Кнопки под уведомлением о товаре
+@callback_router.prefix("remove_ozon_")
+@callback_router.prefix("return_wb_")
+def handle_product_removal(call):
+    try:
+        chat_id = call.message.chat.id
+        if not check_subscription(chat_id):
+            bot.answer_callback_query(call.id, "❗ Ваша подписка истекла. Пожалуйста, обновите подписку.")
+            return
+
+        _, marketplace, product_id = call.data.split('_', 2)
+        bot.answer_callback_query(call.id, "⏳ Обрабатываем товар...")
+        action_ids = [row[0] for row in get_product_promotions(chat_id, marketplace, product_id)]
+        # Ozon снимает товар с конкретной акции, Wildberries возвращает скидку без привязки к акции
+        targets = (action_ids or [None]) if marketplace == 'ozon' else [None]
+
+        succeeded = False
+        for action_id in targets:
+            removed = remove_products_from_promo(chat_id, marketplace, action_id, [product_id])
+            if removed is None:
+                send_message(chat_id, "❗ Не удалось получить данные для доступа к API. Пожалуйста, проверьте настройки интеграции.")
+                return
+            succeeded = succeeded or bool(removed)
+
+        if marketplace == 'ozon':
+            success_text = f"✅ Товар с ID {product_id} успешно удален из акции Ozon."
+            failure_text = f"❌ Не удалось удалить товар с ID {product_id} из акции Ozon."
+        else:
+            success_text = f"✅ Скидка для товара с ID {product_id} успешно возвращена на Wildberries."
+            failure_text = f"❌ Не удалось вернуть скидку для товара с ID {product_id} на Wildberries."
+        if not succeeded:
+            send_message(chat_id, failure_text)
+            return
+
+        log_action(chat_id, marketplace, 'remove_from_promo' if marketplace == 'ozon' else 'return_discount', product_id)
+        for action_id in action_ids:
+            delete_promo_snapshot_products(chat_id, marketplace, action_id, [product_id])
+        send_message(chat_id, success_text + "\n\nℹ️ Изменения могут отражаться на платформе с небольшой задержкой.")
+    except Exception as e:
+        logger.error(f"Error in handle_product_removal: {e}")
+        send_message(call.message.chat.id, "❌ Произошла ошибка при обработке товара. Пожалуйста, попробуйте позже.")
+
+@callback_router.prefix("ignore_ozon_")
+@callback_router.prefix("ignore_wb_")
+def handle_product_ignore(call):
+    try:
+        _, marketplace, product_id = call.data.split('_', 2)
+        add_ignored_product(call.message.chat.id, marketplace, product_id)
+        bot.answer_callback_query(call.id, f"🙈 Товар {product_id} добавлен в исключения")
+    except Exception as e:
+        logger.error(f"Error in handle_product_ignore: {e}")
+        bot.answer_callback_query(call.id, "❌ Произошла ошибка. Пожалуйста, попробуйте позже.")
+
+@callback_router.prefix("stats_ozon_")
+@callback_router.prefix("stats_wb_")
+def handle_product_stats(call):
+    try:
+        chat_id = call.message.chat.id
+        _, marketplace, product_id = call.data.split('_', 2)
+        bot.answer_callback_query(call.id)
+        promotions = get_product_promotions(chat_id, marketplace, product_id)
+        history = get_product_action_stats(chat_id, marketplace, product_id)
+
+        marketplace_name = "Ozon" if marketplace == 'ozon' else "Wildberries"
+        lines = [f"📊 <b>Товар {html.escape(str(product_id))} на {marketplace_name}</b>\n"]
+        if promotions:
+            lines.append(f"📦 Название: {html.escape(str(promotions[0][1] or 'Нет названия'))}")
+            lines.append("🏷 Акции:")
+            for action_id, _, price, discount_price, discount, updated_at in promotions:
+                title = html.escape(str(get_promotion_title(chat_id, marketplace, action_id)))
+                if marketplace == 'ozon':
+                    terms = f"{price if price is not None else '—'} → {discount_price if discount_price is not None else '—'}"
+                else:
+                    terms = f"{price if price is not None else '—'}, скидка {discount if discount is not None else '—'}%"
+                lines.append(f"   • {title}: {terms} (обновлено {updated_at})")
+        else:
+            lines.append("ℹ️ Сейчас товар не найден в акциях.")
+        if history:
+            lines.append(f"\n🕒 Действия за {PRODUCT_STATS_WINDOW_DAYS} дн.:")
+            lines.extend(f"   • {html.escape(action_type)}: {count} (последнее {last_at})"
+                         for action_type, count, last_at in history)
+        send_message(chat_id, "\n".join(lines), parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Error in handle_product_stats: {e}")
+        send_message(call.message.chat.id, "❌ Не удалось получить статистику товара. Пожалуйста, попробуйте позже.")
 
 # 🔄 Функция для периодического мониторинга и уведомлений
+monitoring_executor = ThreadPoolExecutor(max_workers=MONITORING_WORKERS, thread_name_prefix="monitoring")
+fetch_executor = ThreadPoolExecutor(max_workers=MONITORING_FETCH_WORKERS, thread_name_prefix="monitoring-fetch")
+account_cycle_locks = {}
+account_cycle_locks_guard = threading.Lock()
+
+def get_account_cycle_lock(account_key):
+    with account_cycle_locks_guard:
+        lock = account_cycle_locks.get(account_key)
+        if lock is None:
+            lock = account_cycle_locks[account_key] = threading.Lock()
+        return lock
+
+def add_chat_seconds(chat_seconds, chat_id, started):
+    chat_seconds[chat_id] = chat_seconds.get(chat_id, 0) + time.perf_counter() - started
+
+def monitor_promotions(account_key, credentials, subscribers, chat_seconds=None):
+    # subscribers: пары (chat_id, auto_cancel_enabled) всех чатов с этим аккаунтом продавца
+    # chat_seconds: сюда складывается время работы по каждому чату, без общей загрузки страниц
+    # Возвращает True при изменениях, False при спокойном цикле и None, если данные загрузить не удалось
+    marketplace, fingerprint = account_key
+    spec = PROMO_MARKETPLACES[marketplace]
+    chat_seconds = {} if chat_seconds is None else chat_seconds
+    actions = spec['get_actions'](credentials)
+    if actions is None:
+        return None
+    participating = [action for action in actions if spec['is_participating'](action)]
+    changed = False
+    failed = False
+    for chat_id, _ in subscribers:
+        started = time.perf_counter()
+        changed = spec['update_actions'](chat_id, actions) or changed
+        prune_promo_actions(chat_id, marketplace, [action['id'] for action in participating])
+        add_chat_seconds(chat_seconds, chat_id, started)
+    # У каждой акции свой словарь времени: потоки загрузки не пишут в общий
+    futures = {}
+    for action in participating:
+        action_seconds = {}
+        future = fetch_executor.submit(process_promo_products, marketplace, subscribers,
+                                       spec['iter_products'](credentials, action['id']), action, action_seconds)
+        futures[future] = (action, action_seconds)
+    for future in as_completed(futures):
+        action, action_seconds = futures[future]
+        for chat_id, seconds in action_seconds.items():
+            chat_seconds[chat_id] = chat_seconds.get(chat_id, 0) + seconds
+        try:
+            changed = any(future.result().values()) or changed
+        except Exception as e:
+            failed = True
+            logger.error(f"Error processing {marketplace} action {action.get('id')} for account {fingerprint}: {e}")
+    return None if failed and not changed else changed
+
+def parse_promo_time(value):
+    # Даты акций приходят в ISO 8601, часто с 'Z'; приводим к локальному времени без зоны
+    try:
+        moment = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return moment.astimezone().replace(tzinfo=None) if moment.tzinfo else moment
+
+@instrumented('db_helper')
+def get_promotion_boundaries(chat_id, marketplace):
+    try:
+        table_name = 'ozon_promotions' if marketplace == 'ozon' else 'wb_promotions'
+        rows = db.fetchall(f"SELECT date_start, date_end FROM {table_name} WHERE user_id = ?", (chat_id,))
+    except sqlite3.Error as e:
+        logger.error(f"Database error in get_promotion_boundaries: {e}")
+        return []
+    boundaries = (parse_promo_time(value) for row in rows for value in row if value)
+    return [moment for moment in boundaries if moment]
+
+class AdaptivePollScheduler:
+    # Интервал опроса аккаунта сокращается вдвое при изменениях и растёт, пока всё спокойно;
+    # неудачный опрос (changed is None) ничего не говорит о тишине и интервал не растит
+    def __init__(self):
+        self._states = {}  # ключ аккаунта -> [интервал, время следующего опроса]
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def due(self, keys, now):
+        with self._lock:
+            active = set(keys)
+            for key in list(self._states):
+                if key not in active:
+                    del self._states[key]
+            due = [key for key in keys
+                   if key not in self._running
+                   and (key not in self._states or self._states[key][1] <= now)]
+            self._running.update(due)
+            return due
+
+    def record(self, key, changed, boundaries, now):
+        with self._lock:
+            self._running.discard(key)
+            interval = self._states.get(key, [POLL_DEFAULT_INTERVAL])[0]
+            if changed is None:
+                # После сбоя маркетплейса не ждём до POLL_MAX_INTERVAL
+                interval = min(POLL_DEFAULT_INTERVAL, interval)
+            elif changed:
+                interval = max(POLL_MIN_INTERVAL, interval / 2)
+            else:
+                interval = min(POLL_MAX_INTERVAL, interval * POLL_BACKOFF_FACTOR)
+
+            next_poll = now + timedelta(seconds=interval)
+            window = timedelta(seconds=POLL_BOUNDARY_WINDOW)
+            for boundary in boundaries:
+                if abs(boundary - now) <= window:
+                    next_poll = min(next_poll, now + timedelta(seconds=POLL_MIN_INTERVAL))
+                elif now < boundary < next_poll:
+                    # Опрашиваем сразу после начала/окончания акции, а не через полный интервал
+                    next_poll = boundary
+            self._states[key] = [interval, next_poll]
+
+poll_scheduler = AdaptivePollScheduler()
+
+def group_seller_accounts(active_users):
+    # Чаты с одинаковыми ключами API обслуживаются одной загрузкой данных маркетплейса
+    accounts = {}
+    for chat_id, ozon_api_key, ozon_client_id, wb_api_key, auto_cancel_enabled in active_users:
+        if ozon_api_key and ozon_client_id:
+            account = accounts.setdefault(('ozon', credential_fingerprint(ozon_client_id, ozon_api_key)), {
+                'credentials': {'api_key': ozon_api_key, 'client_id': ozon_client_id}, 'subscribers': []})
+            account['subscribers'].append((chat_id, auto_cancel_enabled))
+        if wb_api_key:
+            account = accounts.setdefault(('wb', credential_fingerprint(wb_api_key)), {
+                'credentials': {'api_key': wb_api_key}, 'subscribers': []})
+            account['subscribers'].append((chat_id, auto_cancel_enabled))
+    return accounts
+
+def monitor_account(account_key, credentials, subscribers):
+    marketplace, fingerprint = account_key
+    changed = False
+    started = time.perf_counter()
+    chat_seconds = {}
+
+    # Цикл аккаунта никогда не пересекается с его же предыдущим циклом
+    lock = get_account_cycle_lock(account_key)
+    if not lock.acquire(blocking=False):
+        logger.warning(f"Skipping {marketplace} account {fingerprint}: previous monitoring cycle is still running")
+        poll_scheduler.record(account_key, None, [], datetime.now())
+        return
+
+    try:
+        logger.info(f"Processing {marketplace} account {fingerprint} for {len(subscribers)} chat(s)")
+        changed = monitor_promotions(account_key, credentials, subscribers, chat_seconds)
+    except Exception as e:
+        changed = None
+        logger.error(f"Error processing {marketplace} account {fingerprint}: {e}")
+    finally:
+        lock.release()
+        poll_scheduler.record(account_key, changed,
+                              get_promotion_boundaries(subscribers[0][0], marketplace), datetime.now())
+        # Цикл аккаунта включает общую загрузку страниц, цикл пользователя — только работу по его чату:
+        # сравнение со снимком, уведомления и постановку автоотмены
+        metrics.observe('monitoring_account_cycle_seconds', time.perf_counter() - started, marketplace=marketplace)
+        for chat_id, _ in subscribers:
+            metrics.observe('monitoring_user_cycle_seconds', chat_seconds.get(chat_id, 0), marketplace=marketplace)
+
+def log_monitoring_failure(future):
+    if future.exception():
+        logger.error(f"Error in monitoring worker: {future.exception()}")
+
 def scheduled_monitoring():
+    # Частый тик: отправляет в работу только те аккаунты, у которых подошёл срок опроса
     try:
-        cursor.execute("""
+        active_users = db.fetchall("""
             SELECT chat_id, ozon_api_key, ozon_client_id, wb_api_key, auto_cancel_enabled 
             FROM users 
             WHERE subscription_end >= date('now') AND monitoring_enabled = 1
         """)
-        active_users = cursor.fetchall()
-        
-        for user in active_users:
-            chat_id, ozon_api_key, ozon_client_id, wb_api_key, auto_cancel_enabled = user
-            
-            logger.info(f"Processing user {chat_id}")
-            
-            # Мониторинг Ozon
-            if ozon_api_key and ozon_client_id:
-                try:
-                    ozon_actions = get_ozon_actions(ozon_api_key, ozon_client_id)
-                    update_ozon_actions(chat_id, ozon_actions)
-                    for action in ozon_actions:
-                        if action['is_participating']:
-                            ozon_products = get_ozon_promo_products(ozon_api_key, ozon_client_id, action['id'])
-                            process_ozon_products(chat_id, ozon_products, action, auto_cancel_enabled)
-                except Exception as e:
-                    logger.error(f"Error processing Ozon actions for user {chat_id}: {e}")
-            
-            # Мониторинг Wildberries
-            if wb_api_key:
-                try:
-                    wb_actions = get_wb_actions(wb_api_key)
-                    update_wb_actions(chat_id, wb_actions)
-                    for action in wb_actions:
-                        if action['isActive']:
-                            wb_products = get_wb_promo_products(wb_api_key, action['id'])
-                            process_wb_products(chat_id, wb_products, action, auto_cancel_enabled)
-                except Exception as e:
-                    logger.error(f"Error processing Wildberries actions for user {chat_id}: {e}")
-
+        accounts = group_seller_accounts(active_users)
+        due_accounts = poll_scheduler.due(list(accounts), datetime.now())
+        started = time.perf_counter()
+        remaining = [len(due_accounts)]
+        remaining_lock = threading.Lock()
+
+        def account_done(future):
+            log_monitoring_failure(future)
+            with remaining_lock:
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+            if finished:
+                metrics.observe('monitoring_cycle_seconds', time.perf_counter() - started)
+
+        for account_key in due_accounts:
+            account = accounts[account_key]
+            monitoring_executor.submit(monitor_account, account_key, account['credentials'],
+                                       account['subscribers']).add_done_callback(account_done)
+
+        if due_accounts:
+            logger.info(f"Monitoring tick: {len(due_accounts)} of {len(accounts)} seller accounts due "
+                        f"({len(active_users)} users)")
+            logger.info(f"Marketplace HTTP stats: {marketplace_client.stats()}")
+            logger.info(f"User cache stats: {user_cache.stats()}")
     except Exception as e:
         logger.error(f"Error in scheduled_monitoring: {e}")
 
-def process_ozon_products(chat_id, products, action, auto_cancel_enabled):
-    if products and 'items' in products:
-        ignored_products = get_ignored_products(chat_id, "ozon")
-        for product in products['items']:
-            if product['product_id'] not in ignored_products:
-                message = (
-                    f"🛍 <b>Товар Ozon в акции \"{action['title']}\":</b>\n\n"
-                    f"🆔 ID: {product['product_id']}\n"
-                    f"📦 Название: {product.get('name', 'Нет названия')}\n"
-                    f"💰 Цена: {product.get('price', 'Не указана')}\n"
-                    f"🏷 Цена со скидкой: {product.get('discount_price', 'Не указана')}\n\n"
-                    "Выберите действие:"
-                )
-                keyboard = InlineKeyboardMarkup()
-                keyboard.add(InlineKeyboardButton("🚫 Удалить из акции", callback_data=f"remove_ozon_{product['product_id']}"))
-                keyboard.add(InlineKeyboardButton("🙈 Игнорировать товар", callback_data=f"ignore_ozon_{product['product_id']}"))
-                keyboard.add(InlineKeyboardButton("📊 Подробная статистика", callback_data=f"stats_ozon_{product['product_id']}"))
-                try:
-                    bot.send_message(chat_id, message, reply_markup=keyboard, parse_mode="HTML")
-                except Exception as e:
-                    logger.error(f"Error sending Ozon message to user {chat_id}: {e}")
-                
-                if auto_cancel_enabled:
-                    add_pending_action(chat_id, 'ozon', product['product_id'], 'remove_from_promo')
-
-def process_wb_products(chat_id, products, action, auto_cancel_enabled):
-    if products:
-        ignored_products = get_ignored_products(chat_id, "wb")
-        for product in products:
-            if str(product.get('nmId', '')) not in ignored_products:
-                message = (
-                    f"🛒 <b>Товар Wildberries в акции \"{action['name']}\":</b>\n\n"
-                    f"🆔 ID: {product.get('nmId', 'Нет ID')}\n"
-                    f"📦 Название: {product.get('name', 'Нет названия')}\n"
-                    f"💰 Цена: {product.get('price', 'Не указана')}\n"
-                    f"🏷 Скидка: {product.get('discount', 'Не указана')}%\n\n"
-                    "Выберите действие:"
-                )
-                keyboard = InlineKeyboardMarkup()
-                keyboard.add(InlineKeyboardButton("🔄 Вернуть скидку", callback_data=f"return_wb_{product.get('nmId', '')}"))
-                keyboard.add(InlineKeyboardButton("🙈 Игнорировать товар", callback_data=f"ignore_wb_{product.get('nmId', '')}"))
-                keyboard.add(InlineKeyboardButton("📊 Подробная статистика", callback_data=f"stats_wb_{product.get('nmId', '')}"))
-                try:
-                    bot.send_message(chat_id, message, reply_markup=keyboard, parse_mode="HTML")
-                except Exception as e:
-                    logger.error(f"Error sending Wildberries message to user {chat_id}: {e}")
-                
-                if auto_cancel_enabled:
-                    add_pending_action(chat_id, 'wb', str(product.get('nmId', '')), 'return_discount')
+def diff_promo_page(chat_id, marketplace, action_id, products, get_product_id, get_state, floors):
+    # Возвращает новые и изменившиеся товары страницы и сохраняет их в снимок вместе с маржой к шаблону
+    snapshot = get_promo_snapshot(chat_id, marketplace, action_id, [get_product_id(product) for product in products])
+    changed = []
+    snapshot_rows = []
+    for product in products:
+        product_id = get_product_id(product)
+        state = get_state(product)
+        if snapshot.get(product_id) != state:
+            changed.append(product)
+            snapshot_rows.append((product_id, product.get('name'), *state,
+                                  promo_margin(state, floors.get(product_id))))
+    save_promo_snapshot(chat_id, marketplace, action_id, snapshot_rows)
+    return changed
+
+def ozon_product_state(product):
+    return (to_number(product.get('price')),
+            to_number(product.get('action_price', product.get('discount_price'))),
+            None)
+
+def wb_product_state(product):
+    return (to_number(product.get('price')), None, to_number(product.get('discount')))
+
+def promo_price(state):
+    # Цена товара в акции: у Ozon — цена акции, у Wildberries — цена с учётом скидки
+    price, discount_price, discount = state
+    if discount_price is not None:
+        return discount_price
+    if price is None or discount is None:
+        return None
+    return price * (100 - discount) / 100
+
+def promo_margin(state, floor):
+    price = promo_price(state)
+    if price is None or floor is None:
+        return None
+    return price - floor
+
+def select_floor_breaches(products, floors, get_product_id, get_state):
+    # Хэш-соединение страницы с порогами шаблона за один проход; товары без порога
+    # или без известной цены акции остаются в выборке, как и раньше
+    if not floors:
+        return [(product, None) for product in products]
+    breaches = []
+    for product in products:
+        floor = floors.get(get_product_id(product))
+        if floor is None:
+            breaches.append((product, None))
+            continue
+        price = promo_price(get_state(product))
+        if price is None or price < floor:
+            breaches.append((product, floor))
+    return breaches
+
+def notify_ozon_product(chat_id, product, action, floor=None):
+    message = (
+        f"🛍 <b>Товар Ozon в акции \"{action['title']}\":</b>\n\n"
+        f"🆔 ID: {product['product_id']}\n"
+        f"📦 Название: {product.get('name', 'Нет названия')}\n"
+        f"💰 Цена: {product.get('price', 'Не указана')}\n"
+        f"🏷 Цена со скидкой: {product.get('discount_price', 'Не указана')}\n"
+        + (f"📉 Минимальная цена по шаблону: {floor:.2f}\n" if floor is not None else "")
+        + "\nВыберите действие:"
+    )
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("🚫 Удалить из акции", callback_data=f"remove_ozon_{product['product_id']}"))
+    keyboard.add(InlineKeyboardButton("🙈 Игнорировать товар", callback_data=f"ignore_ozon_{product['product_id']}"))
+    keyboard.add(InlineKeyboardButton("📊 Подробная статистика", callback_data=f"stats_ozon_{product['product_id']}"))
+    notify(chat_id, message, reply_markup=keyboard, parse_mode="HTML")
+
+def notify_wb_product(chat_id, product, action, floor=None):
+    message = (
+        f"🛒 <b>Товар Wildberries в акции \"{action['name']}\":</b>\n\n"
+        f"🆔 ID: {product.get('nmId', 'Нет ID')}\n"
+        f"📦 Название: {product.get('name', 'Нет названия')}\n"
+        f"💰 Цена: {product.get('price', 'Не указана')}\n"
+        f"🏷 Скидка: {product.get('discount', 'Не указана')}%\n"
+        + (f"📉 Минимальная цена по шаблону: {floor:.2f}\n" if floor is not None else "")
+        + "\nВыберите действие:"
+    )
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("🔄 Вернуть скидку", callback_data=f"return_wb_{product.get('nmId', '')}"))
+    keyboard.add(InlineKeyboardButton("🙈 Игнорировать товар", callback_data=f"ignore_wb_{product.get('nmId', '')}"))
+    keyboard.add(InlineKeyboardButton("📊 Подробная статистика", callback_data=f"stats_wb_{product.get('nmId', '')}"))
+    notify(chat_id, message, reply_markup=keyboard, parse_mode="HTML")
+
+def process_promo_products(marketplace, subscribers, pages, action, chat_seconds=None):
+    # Каждая страница загружается один раз и разбирается для всех чатов аккаунта
+    spec = PROMO_MARKETPLACES[marketplace]
+    get_product_id, get_state, cancel_action = spec['product_id'], spec['product_state'], spec['cancel_action']
+    chat_seconds = {} if chat_seconds is None else chat_seconds
+    ignored_products = {chat_id: get_ignored_products(chat_id, marketplace) for chat_id, _ in subscribers}
+    price_floors = {chat_id: get_price_floors(chat_id, marketplace) for chat_id, _ in subscribers}
+    # Один товар аккаунта снимается одной задачей, даже если автоотмена включена у нескольких чатов
+    queued_product_ids = get_queued_product_ids([chat_id for chat_id, enabled in subscribers if enabled],
+                                                marketplace, action['id'], cancel_action)
+    seen_product_ids = set()
+    notified = dict.fromkeys(ignored_products, 0)
+    # Сводка уходит и при ошибке на середине акции: изменения прочитанных страниц уже в снимке
+    # и в очереди автоотмены, и следующий цикл их не повторит
+    completed = False
+    try:
+        for products in pages:
+            seen_product_ids.update(get_product_id(product) for product in products)
+            for chat_id, auto_cancel_enabled in subscribers:
+                started = time.perf_counter()
+                changed = diff_promo_page(chat_id, marketplace, action['id'], products, get_product_id, get_state,
+                                          price_floors[chat_id])
+                changed = [product for product in changed if get_product_id(product) not in ignored_products[chat_id]]
+                to_cancel = []
+                for product, floor in select_floor_breaches(changed, price_floors[chat_id], get_product_id, get_state):
+                    notified[chat_id] += 1
+                    if NOTIFICATION_MODE != 'digest':
+                        spec['notify_product'](chat_id, product, action, floor)
+
+                    if auto_cancel_enabled and get_product_id(product) not in queued_product_ids:
+                        queued_product_ids.add(get_product_id(product))
+                        to_cancel.append(get_product_id(product))
+                if to_cancel:
+                    add_pending_actions(chat_id, marketplace, to_cancel, cancel_action, action['id'])
+                add_chat_seconds(chat_seconds, chat_id, started)
+        completed = True
+    finally:
+        for chat_id, _ in subscribers:
+            started = time.perf_counter()
+            if completed:
+                prune_promo_snapshot(chat_id, marketplace, action['id'], seen_product_ids)
+            if NOTIFICATION_MODE == 'digest' and notified[chat_id]:
+                send_promo_digest(chat_id, marketplace, action['id'], notified[chat_id])
+            add_chat_seconds(chat_seconds, chat_id, started)
+    return notified
+
+# Всё, чем маркетплейсы различаются в мониторинге акций
+PROMO_MARKETPLACES = {
+    'ozon': {
+        'get_actions': lambda credentials: get_ozon_actions(credentials['api_key'], credentials['client_id']),
+        'is_participating': lambda action: action['is_participating'],
+        'update_actions': update_ozon_actions,
+        'iter_products': lambda credentials, action_id: iter_ozon_promo_products(
+            credentials['api_key'], credentials['client_id'], action_id),
+        'product_id': lambda product: str(product['product_id']),
+        'product_state': ozon_product_state,
+        'notify_product': notify_ozon_product,
+        'cancel_action': 'remove_from_promo',
+    },
+    'wb': {
+        'get_actions': lambda credentials: get_wb_actions(credentials['api_key']),
+        'is_participating': lambda action: action['isActive'],
+        'update_actions': update_wb_actions,
+        'iter_products': lambda credentials, action_id: iter_wb_promo_products(credentials['api_key'], action_id),
+        'product_id': lambda product: str(product.get('nmId', '')),
+        'product_state': wb_product_state,
+        'notify_product': notify_wb_product,
+        'cancel_action': 'return_discount',
+    },
+}
 
 # 🕒 Функция для обработки отложенных действий
+@instrumented('db_helper')
+def finish_pending_batch(user_id, marketplace, lease_token, jobs, removed, error):
+    # jobs: тройки (id, product_id, attempts); возвращает количество задач, ушедших в dead
+    action_type = 'auto_remove_from_promo' if marketplace == 'ozon' else 'auto_return_discount'
+    removed = set(removed)
+    done_ids = [pending_id for pending_id, product_id, _ in jobs if product_id in removed]
+    failed_jobs = [(pending_id, attempts) for pending_id, product_id, attempts in jobs if product_id not in removed]
+
+    def write_results(cursor):
+        record_actions(cursor, user_id, marketplace, action_type, removed)
+        complete_pending_actions(cursor, lease_token, done_ids)
+        return fail_pending_actions(cursor, lease_token, failed_jobs, error)
+
+    return db.transaction(write_results)
+
+def pending_batch_summary(user_id, marketplace, action_id, removed_count, total, dead_count):
+    failed = total - removed_count
+    retrying = failed - dead_count
+    if marketplace == 'ozon':
+        title = f" \"{get_promotion_title(user_id, 'ozon', action_id)}\"" if action_id else ""
+        text = f"✅ Автоматически удалено товаров из акции Ozon{title}: {removed_count} из {total}."
+        if dead_count:
+            text += f"\n❌ Не удалось удалить после {PENDING_MAX_ATTEMPTS} попыток: {dead_count}."
+    else:
+        title = f" в акции \"{get_promotion_title(user_id, 'wb', action_id)}\"" if action_id else ""
+        text = f"✅ Автоматически возвращена скидка на Wildberries{title}: {removed_count} из {total} товаров."
+        if dead_count:
+            text += f"\n❌ Не удалось вернуть скидку после {PENDING_MAX_ATTEMPTS} попыток: {dead_count}."
+    if retrying:
+        text += f"\n🔄 Повторная попытка позже: {retrying}."
+    return text
+
 def process_pending_actions():
     try:
-        pending_actions = get_pending_actions()
-        for action in pending_actions:
-            action_id, user_id, marketplace, product_id, action_type = action
-            
-            if marketplace == 'ozon':
-                ozon_credentials = get_marketplace_credentials(user_id, 'ozon')
-                if ozon_credentials:
-                    ozon_api_key, ozon_client_id = ozon_credentials['api_key'], ozon_credentials['client_id']
-                    if remove_ozon_product_from_promo(ozon_api_key, ozon_client_id, product_id):
-                        bot.send_message(user_id, f"✅ Товар с ID {product_id} автоматически удален из акции Ozon.")
-                        log_action(user_id, 'ozon', 'auto_remove_from_promo', product_id)
-                    else:
-                        bot.send_message(user_id, f"❌ Не удалось автоматически удалить товар с ID {product_id} из акции Ozon.")
-            elif marketplace == 'wb':
-                wb_credentials = get_marketplace_credentials(user_id, 'wb')
-                if wb_credentials:
-                    wb_api_key = wb_credentials['api_key']
-                    product_data = {
-                        "nmId": int(product_id),
-                        "discount": 0
-                    }
-                    if update_wb_product_discount(wb_api_key, product_data):
-                        bot.send_message(user_id, f"✅ Скидка для товара с ID {product_id} автоматически возвращена на Wildberries.")
-                        log_action(user_id, 'wb', 'auto_return_discount', product_id)
-                    else:
-                        bot.send_message(user_id, f"❌ Не удалось автоматически вернуть скидку для товара с ID {product_id} на Wildberries.")
-            
-            remove_pending_action(action_id)
+        lease_token, jobs = claim_pending_actions()
+
+        # Группируем задачи по (пользователь, маркетплейс, акция)
+        batches = {}
+        for pending_id, user_id, marketplace, product_id, action_type, action_id, attempts in jobs:
+            batches.setdefault((user_id, marketplace, action_id), []).append((pending_id, str(product_id), attempts))
+
+        credentials_cache = {}
+        for (user_id, marketplace, action_id), batch_jobs in batches.items():
+            try:
+                if (user_id, marketplace) not in credentials_cache:
+                    credentials_cache[(user_id, marketplace)] = get_marketplace_credentials(user_id, marketplace)
+                credentials = credentials_cache[(user_id, marketplace)]
+                product_ids = list(dict.fromkeys(product_id for _, product_id, _ in batch_jobs))
+
+                if not credentials or not credentials.get('api_key'):
+                    finish_pending_batch(user_id, marketplace, lease_token, batch_jobs, [], "missing API credentials")
+                    continue
+
+                removed = remove_products_from_promo(user_id, marketplace, action_id, product_ids, credentials)
+                # Товары, которые маркетплейс отклонил или не подтвердил, уходят на повтор как неудачные
+                dead_count = finish_pending_batch(user_id, marketplace, lease_token, batch_jobs, removed,
+                                                  "removal not confirmed by marketplace API")
+                if removed or dead_count:
+                    notify(user_id, pending_batch_summary(user_id, marketplace, action_id,
+                                                          len(removed), len(product_ids), dead_count))
+            except Exception as e:
+                # Аренда истечёт, и задачи будут подхвачены повторно
+                logger.error(f"Error processing pending actions for user {user_id} ({marketplace}, {action_id}): {e}")
     except Exception as e:
         logger.error(f"Error in process_pending_actions: {e}")
 
+# ⏰ Планировщик отложенных действий: спит до ближайшего срока вместо периодического опроса
+class PendingActionScheduler:
+    def __init__(self):
+        self._deadlines = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        deadline = next_pending_deadline()
+        if deadline:
+            self.schedule(deadline)
+        self._thread = threading.Thread(target=self._run, name="pending-actions", daemon=True)
+        self._thread.start()
+
+    def schedule(self, deadline):
+        with self._condition:
+            # Более поздние сроки всё равно будут перечитаны из базы после ближайшего запуска
+            if self._deadlines and deadline >= self._deadlines[0]:
+                return
+            heapq.heappush(self._deadlines, deadline)
+            self._condition.notify()
+
+    def _wait_for_due(self):
+        with self._condition:
+            while True:
+                now = datetime.now()
+                if self._deadlines and self._deadlines[0] <= now:
+                    break
+                timeout = (self._deadlines[0] - now).total_seconds() if self._deadlines else None
+                self._condition.wait(timeout)
+            while self._deadlines and self._deadlines[0] <= now:
+                heapq.heappop(self._deadlines)
+
+    def _run(self):
+        while True:
+            self._wait_for_due()
+            try:
+                process_pending_actions()
+            except Exception as e:
+                logger.error(f"Error in pending action scheduler: {e}")
+            # Повторы, истёкшие аренды и остаток сверх лимита выборки
+            deadline = next_pending_deadline()
+            if deadline:
+                self.schedule(deadline)
+
+pending_scheduler = PendingActionScheduler()
+
+# 🧹 Обслуживание базы: архивирование старых журналов и освобождение места
+maintenance_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="maintenance")
+maintenance_lock = threading.Lock()
+
+@instrumented('db_helper')
+def archive_action_log(marketplace, cutoff):
+    # Старые записи пачками дописываются в архив своего месяца и только после этого удаляются;
+    # дневные сводки (action_daily_stats) уже содержат их и не меняются
+    table_name = f"{marketplace}_actions"
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    archived = 0
+    while True:
+        rows = db.fetchall(f"""
+            SELECT id, user_id, action_type, product_id, date FROM {table_name}
+            WHERE date < ? ORDER BY id LIMIT ?
+        """, (cutoff, MAINTENANCE_BATCH_SIZE))
+        if not rows:
+            return archived
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(row[4][:7], []).append(row)
+        for month, month_rows in by_month.items():
+            path = os.path.join(ARCHIVE_DIR, f"{table_name}_{month}.csv.gz")
+            is_new = not os.path.exists(path)
+            # Дозапись в gzip создаёт новый фрагмент, файл читается как один CSV
+            with gzip.open(path, 'at', encoding='utf-8', newline='') as archive:
+                writer = csv.writer(archive)
+                if is_new:
+                    writer.writerow(['id', 'user_id', 'action_type', 'product_id', 'date'])
+                writer.writerows(month_rows)
+        archived += db.execute(f"DELETE FROM {table_name} WHERE date < ? AND id <= ?", (cutoff, rows[-1][0]))
+        if len(rows) < MAINTENANCE_BATCH_SIZE:
+            return archived
+
+@instrumented('db_helper')
+def purge_rows(table_name, condition, params):
+    # Каждая пачка — отдельная короткая транзакция, мониторинг и обработчики не ждут долго
+    deleted = 0
+    while True:
+        count = db.execute(f"""
+            DELETE FROM {table_name} WHERE id IN (SELECT id FROM {table_name} WHERE {condition} LIMIT ?)
+        """, (*params, MAINTENANCE_BATCH_SIZE))
+        deleted += count
+        if count < MAINTENANCE_BATCH_SIZE:
+            return deleted
+
+@instrumented('db_helper')
+def reclaim_free_pages():
+    reclaimed = 0
+    while True:
+        free_pages = db.fetchone("PRAGMA freelist_count")[0]
+        if not free_pages:
+            return reclaimed
+        # fetchall: incremental_vacuum освобождает страницы по мере пошагового выполнения
+        db.transaction(lambda cursor: cursor.execute(f"PRAGMA incremental_vacuum({MAINTENANCE_VACUUM_PAGES})").fetchall())
+        after = db.fetchone("PRAGMA freelist_count")[0]
+        if after >= free_pages:
+            return reclaimed
+        reclaimed += free_pages - after
+
+def uses_incremental_vacuum():
+    return db.fetchone("PRAGMA auto_vacuum")[0] == 2
+
+def convert_to_incremental_vacuum():
+    # Полный VACUUM переписывает весь файл и блокирует запись на всё время работы: только вручную
+    if uses_incremental_vacuum():
+        logger.info("Database already uses incremental auto_vacuum")
+        return
+    started = time.monotonic()
+    logger.info("Converting database to incremental auto_vacuum")
+    db.vacuum()
+    logger.info(f"Database converted to incremental auto_vacuum in {time.monotonic() - started:.1f}s")
+
+def run_maintenance():
+    if not maintenance_lock.acquire(blocking=False):
+        logger.warning("Skipping database maintenance: previous run is still in progress")
+        return
+    try:
+        started = time.monotonic()
+        cutoff = db.fetchone("SELECT datetime('now', ?)", (f"-{LOG_RETENTION_DAYS} days",))[0]
+        archived = {marketplace: archive_action_log(marketplace, cutoff) for marketplace in ('ozon', 'wb')}
+        pending = purge_rows('pending_actions', "state IN ('done', 'dead') AND notification_time < ?",
+                             (db_time(datetime.now() - timedelta(days=PENDING_RETENTION_DAYS)),))
+        product_stats = purge_rows('product_daily_stats', "day < date('now', ?)", (f"-{LOG_RETENTION_DAYS} days",))
+        if uses_incremental_vacuum():
+            pages = reclaim_free_pages()
+        else:
+            pages = 0
+            logger.warning("Free pages are not reclaimed: run 'python main2.py --vacuum' to enable incremental auto_vacuum")
+        logger.info(f"Database maintenance done in {time.monotonic() - started:.1f}s: archived {archived}, "
+                    f"purged {pending} pending actions and {product_stats} product stats rows, reclaimed {pages} pages")
+    except Exception as e:
+        logger.error(f"Error in run_maintenance: {e}")
+    finally:
+        maintenance_lock.release()
+
+def scheduled_maintenance():
+    maintenance_executor.submit(run_maintenance)
+
+# 🌍 Режим webhook: HTTP-сервер кладёт обновления в ограниченную очередь, пул потоков их обрабатывает
+def update_chat_id(update):
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    if update.pre_checkout_query:
+        return update.pre_checkout_query.from_user.id
+    return update.update_id
+
+class WebhookServer:
+    def __init__(self, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET_TOKEN,
+                 workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+        self.path = path
+        self.secret_token = secret_token
+        # Очередь на каждый поток: обновления одного чата обрабатываются по порядку
+        self._queues = [queue.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self._metrics = {'received': 0, 'processed': 0, 'failed': 0, 'rejected': 0, 'unauthorized': 0, 'invalid': 0}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((listen, port), self._handler_class())
+        self._httpd.daemon_threads = True
+
+    def _count(self, metric):
+        metrics.inc('webhook_updates_total', outcome=metric)
+        with self._lock:
+            self._metrics[metric] += 1
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics['queued'] = sum(updates.qsize() for updates in self._queues)
+        return metrics
+
+    def submit(self, update):
+        updates = self._queues[hash(update_chat_id(update)) % len(self._queues)]
+        try:
+            updates.put_nowait(update)
+        except queue.Full:
+            self._count('rejected')
+            return False
+        self._count('received')
+        return True
+
+    def _worker(self, updates):
+        while True:
+            update = updates.get()
+            try:
+                bot.process_new_updates([update])
+                self._count('processed')
+            except Exception as e:
+                self._count('failed')
+                logger.error(f"Error processing update {update.update_id}: {e}")
+
+    def _handler_class(self):
+        webhook = self
+
+        class WebhookRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != f"{webhook.path}/metrics":
+                    self._reply(404)
+                    return
+                self._reply(200, json.dumps(webhook.metrics()).encode('utf-8'), 'application/json')
+
+            def do_POST(self):
+                if self.path != webhook.path:
+                    self._reply(404)
+                    return
+                if webhook.secret_token and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != webhook.secret_token:
+                    webhook._count('unauthorized')
+                    self._reply(403)
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                if length <= 0 or length > WEBHOOK_MAX_BODY:
+                    webhook._count('invalid')
+                    self._reply(413 if length > WEBHOOK_MAX_BODY else 400)
+                    return
+                try:
+                    update = telebot.types.Update.de_json(self.rfile.read(length).decode('utf-8'))
+                except (ValueError, KeyError, TypeError) as e:
+                    webhook._count('invalid')
+                    logger.warning(f"Invalid webhook payload: {e}")
+                    self._reply(400)
+                    return
+                if webhook.submit(update):
+                    self._reply(200)
+                else:
+                    self._reply(503, headers={'Retry-After': '1'})
+
+            def _reply(self, status, body=b'', content_type='text/plain', headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"Webhook {self.address_string()}: {format % args}")
+
+        return WebhookRequestHandler
+
+    def serve_forever(self):
+        for index, updates in enumerate(self._queues):
+            threading.Thread(target=self._worker, args=(updates,), name=f"webhook-worker-{index}", daemon=True).start()
+        logger.info(f"Webhook server listening on {self._httpd.server_address[0]}:{self._httpd.server_address[1]}{self.path}")
+        self._httpd.serve_forever()
+
+    def shutdown(self):
+        self._httpd.shutdown()
+
+def run_webhook():
+    bot.remove_webhook()
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET_TOKEN or None, max_connections=WEBHOOK_WORKERS)
+    WebhookServer().serve_forever()
+
+# 🧪 Локальный клиент: отправляет записанные обновления на webhook и измеряет пропускную способность
+def replay_updates(path, url, concurrency=WEBHOOK_WORKERS, secret_token=WEBHOOK_SECRET_TOKEN):
+    # Файл: JSON-массив обновлений или по одному обновлению в строке
+    with open(path, encoding='utf-8') as f:
+        content = f.read().strip()
+    updates = json.loads(content) if content.startswith('[') else [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    session = requests.Session()
+    session.mount(url, HTTPAdapter(pool_maxsize=concurrency))
+    headers = {'Content-Type': 'application/json'}
+    if secret_token:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret_token
+
+    def post(update):
+        try:
+            return session.post(url, data=json.dumps(update), headers=headers, timeout=HTTP_READ_TIMEOUT).status_code
+        except requests.RequestException:
+            return 'error'
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        statuses = list(executor.map(post, updates))
+    elapsed = time.monotonic() - started
+    counts = {status: statuses.count(status) for status in set(statuses)}
+    logger.info(f"Replayed {len(updates)} updates in {elapsed:.2f}s ({len(updates) / max(elapsed, 1e-9):.0f} updates/s): {counts}")
+    return counts
+
 # 🚀 Запуск бота
 if __name__ == "__main__":
     import threading
     import schedule
     import time
 
+    # python main2.py replay <файл с обновлениями> <адрес webhook> — нагрузочный прогон без Telegram
+    if len(sys.argv) >= 4 and sys.argv[1] == 'replay':
+        replay_updates(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    # python main2.py --vacuum — разовый перевод существующей базы на инкрементальную очистку, при остановленном боте
+    if len(sys.argv) >= 2 and sys.argv[1] == '--vacuum':
+        convert_to_incremental_vacuum()
+        sys.exit(0)
+
+    # python main2.py --check-plans — проверка планов горячих запросов для CI, ненулевой код при регрессии
+    if len(sys.argv) >= 2 and sys.argv[1] == '--check-plans':
+        regressions = check_query_plans()
+        for name, detail in regressions:
+            print(f"{name}: {detail}")
+        sys.exit(1 if regressions else 0)
+
     def run_schedule():
         while True:
             schedule.run_pending()
             time.sleep(1)
 
-    # Запланировать выполнение мониторинга каждые 30 минут
-    schedule.every(10).minutes.do(scheduled_monitoring)
+    check_query_plans()
+
+    # Метрики для Prometheus на локальном порту
+    if METRICS_PORT:
+        start_metrics_server()
+
+    # Проверять, кому из пользователей пора в мониторинг
+    schedule.every(POLL_TICK).seconds.do(scheduled_monitoring)
     
-    # Запланировать обработку отложенных действий каждые 10 минут
-    schedule.every(10).minutes.do(process_pending_actions)
+    # Запустить обработку отложенных действий по их срокам
+    pending_scheduler.start()
+
+    # Раз в сутки архивировать старые журналы и освобождать место в базе
+    schedule.every().day.at(MAINTENANCE_TIME).do(scheduled_maintenance)
 
     # Запустить планировщик в отдельном потоке
     schedule_thread = threading.Thread(target=run_schedule)
     schedule_thread.start()
 
     # Запустить бота
-    while True:
-        try:
-            bot.polling(none_stop=True)
-        except Exception as e:
-            logger.error(f"Bot polling error: {e}")
-            time.sleep(15)
+    if BOT_MODE == 'webhook':
+        run_webhook()
+    else:
+        while True:
+            try:
+                bot.polling(none_stop=True)
+            except Exception as e:
+                logger.error(f"Bot polling error: {e}")
+                time.sleep(15)